@@ -0,0 +1,51 @@
+"""Benchmark of the generation of identifiers. It reports the time for
+generating uuids and mac addresses with the former character by character
+generators, ``gen_uuid``/``gen_mac`` and an ``IdAllocator`` (which also
+checks identifiers are unique), and the number of mac addresses generated by
+``gen_mac`` colliding with previous ones.
+
+Usage: python benchmarks/bench_ids.py [NB_IDS]
+"""
+
+import os
+import sys
+import random
+import string
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import kvm
+
+CHOICES = string.ascii_letters[:6] + string.digits
+
+
+def old_uuid():
+    return '-'.join(''.join([random.choice(CHOICES) for _ in range(0, size)])
+                    for size in (8, 4, 4, 4, 12))
+
+def old_mac():
+    return ':'.join(('54', '52', '00')
+                    + tuple(''.join([random.choice(CHOICES) for _ in range(0, 2)])
+                            for _ in range(0, 3)))
+
+def main():
+    nb_ids = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%d identifiers' % nb_ids)
+    print('%-12s %12s %12s' % ('generator', 'uuid (us)', 'mac (us)'))
+
+    allocator = kvm.IdAllocator()
+    cases = (('characters', old_uuid, old_mac),
+             ('gen_*', kvm.gen_uuid, kvm.gen_mac),
+             ('allocator', allocator.uuid, allocator.mac))
+    for name, gen_uuid, gen_mac in cases:
+        print('%-12s %12.2f %12.2f'
+              % (name,
+                 timeit.timeit(gen_uuid, number=nb_ids) / nb_ids * 1e6,
+                 timeit.timeit(gen_mac, number=nb_ids) / nb_ids * 1e6))
+
+    macs = [kvm.gen_mac() for _ in range(nb_ids)]
+    print('\ngen_mac collisions: %d' % (len(macs) - len(set(macs))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Benchmark of the time for importing the library. Each import is done in a
+new interpreter with ``-X importtime`` (python 3.7+) and the median of the
+runs is reported for the ``kvm`` module (its own time and the time including
+its dependencies) and its main dependencies.
+
+Usage: python benchmarks/bench_import.py [-n NUMBER]
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+MODULES = ('kvm', 'unix', 'paramiko', 'lxml.etree', 'json', 'asyncio')
+
+
+def import_times(code):
+    """Return the times (self, cumulative) in us of each imported module when
+    executing **code** in a new interpreter."""
+    env = dict(os.environ, PYTHONPATH=os.path.join(HERE, '..'))
+    stderr = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                              stderr=subprocess.PIPE, env=env,
+                              universal_newlines=True).communicate()[1]
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = (int(self_time), int(cumulative))
+    return times
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help='number of imports (default: 10)')
+    args = parser.parse_args()
+
+    runs = [import_times('import kvm') for _ in range(args.number)]
+    print('%-12s %12s %12s' % ('module', 'self (ms)', 'total (ms)'))
+    for module in MODULES:
+        times = [run[module] for run in runs if module in run]
+        if not times:
+            print('%-12s %12s %12s' % (module, '-', 'not imported'))
+            continue
+        print('%-12s %12.2f %12.2f' % (module,
+                                       median(t[0] for t in times) / 1000.,
+                                       median(t[1] for t in times) / 1000.))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Benchmark of the overhead of the library. Commands are executed on the
+local host with stand-ins of ``virsh`` and ``qemu-img`` (in the ``fake``
+directory) replaying real outputs at scale, so the results only depend on the
+library (and on the cost of starting a process). For each method, it reports:
+
+    * the number of calls per second,
+    * the time spent for parsing the output of the command,
+    * the peak of memory allocated by python during a call.
+
+Usage: python benchmarks/bench_kvm.py [-h] [options]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+import unix
+import kvm
+
+
+# Name, method, virsh command (name, args, options) and parser of its output.
+CASES = (
+    ('list_domains', lambda h: h.list_domains(all=True),
+     ('list', (), {'all': True}), kvm._domains),
+    ('list_pools', lambda h: h.list_pools(details=True),
+     ('pool-list', (), {'details': True}), kvm._pools),
+    ('list_volumes', lambda h: h.list_volumes('default', details=True),
+     ('vol-list', ('default',), {'details': True}), kvm._volumes),
+    ('hypervisor.nodeinfo', lambda h: h.hypervisor.nodeinfo(),
+     ('nodeinfo', (), {}), kvm._dict),
+    ('domain.state', lambda h: h.domain.state('guest0'),
+     ('domstate', ('guest0',), {}),
+     lambda lines: kvm._parse(kvm._MAPPING['domain']['state'], lines)),
+    ('domain.info', lambda h: h.domain.info('guest0'),
+     ('dominfo', ('guest0',), {}), kvm._dict),
+    ('domain.blkstat', lambda h: h.domain.blkstat('guest0', 'vda'),
+     ('domblkstat', ('guest0', 'vda'), {}),
+     lambda lines: kvm._parse(kvm._MAPPING['domain']['blkstat'], lines)),
+    ('domain.conf', lambda h: h.domain.conf('guest0'),
+     ('dumpxml', ('guest0',), {}),
+     lambda lines: kvm._parse(kvm._MAPPING['domain']['conf'], lines)),
+    ('domain_stats', lambda h: h.domain_stats(),
+     ('domstats', (), {}),
+     lambda lines: kvm._domstats(kvm._domstats_records(lines))),
+)
+
+
+def measure(func, number):
+    start = time.time()
+    for _ in range(number):
+        func()
+    return (time.time() - start) / number
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=5,
+                        help='number of calls of each method (default: 5)')
+    parser.add_argument('--domains', type=int, default=1000,
+                        help='number of domains (default: 1000)')
+    parser.add_argument('--volumes', type=int, default=10000,
+                        help='number of volumes (default: 10000)')
+    parser.add_argument('--disks', type=int, default=100,
+                        help='number of disks of domains (default: 100)')
+    parser.add_argument('--session', action='store_true',
+                        help='use a persistent virsh session')
+    parser.add_argument('methods', nargs='*',
+                        help='methods to benchmark (default: all)')
+    args = parser.parse_args()
+
+    os.environ['PATH'] = '%s:%s' % (os.path.join(HERE, 'fake'), os.environ['PATH'])
+    os.environ['KVM_BENCH_DOMAINS'] = str(args.domains)
+    os.environ['KVM_BENCH_VOLUMES'] = str(args.volumes)
+    os.environ['KVM_BENCH_DISKS'] = str(args.disks)
+    hypervisor = kvm.Hypervisor(unix.Local(), session=args.session)
+
+    print('%-22s %12s %14s %12s' % ('method', 'calls/s', 'parse (ms)', 'peak (KiB)'))
+    for name, method, (command, cmd_args, cmd_opts), parse in CASES:
+        if args.methods and name not in args.methods:
+            continue
+        with hypervisor.set_controls(parse=True):
+            lines = hypervisor.virsh(command, *cmd_args, **cmd_opts)
+        duration = measure(lambda: method(hypervisor), args.number)
+        parse_duration = measure(lambda: parse(lines), args.number)
+        peak = peak_memory(lambda: method(hypervisor))
+        print('%-22s %12.1f %14.3f %12.1f'
+              % (name, 1 / duration, parse_duration * 1e3, peak / 1024.))
+
+    if not args.methods or 'image.info' in args.methods:
+        path = '/var/lib/libvirt/images/guest0.qcow2'
+        duration = measure(lambda: hypervisor.image.info(path), args.number)
+        stdout = hypervisor.execute('qemu-img info', path)[1].splitlines()
+        parse_duration = measure(lambda: kvm._dict(stdout), args.number)
+        peak = peak_memory(lambda: hypervisor.image.info(path))
+        print('%-22s %12.1f %14.3f %12.1f'
+              % ('image.info', 1 / duration, parse_duration * 1e3, peak / 1024.))
+
+    if not args.methods or 'from_xml' in args.methods:
+        import lxml.etree as etree
+        from samples import domain_xml
+        elt = etree.fromstring(domain_xml(args.disks, 4))
+        duration = measure(lambda: kvm.from_xml(elt, ['disk', 'interface']),
+                           args.number)
+        peak = peak_memory(lambda: kvm.from_xml(elt, ['disk', 'interface']))
+        print('%-22s %12.1f %14.3f %12.1f'
+              % ('from_xml', 1 / duration, duration * 1e3, peak / 1024.))
+    hypervisor.close_session()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark of typed records against dictionnaries for the output of
+``virsh vol-list --details``. For both results, it reports the time for
+parsing the output, the memory used by the result and the time for sorting
+volumes by allocation and filtering the volumes allocating more than 10 GiB
+(sizes of dictionnaries have to be converted to bytes for this).
+
+Usage: python benchmarks/bench_records.py [NB_VOLUMES]
+"""
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import kvm
+
+
+def vol_list(nb_volumes):
+    lines = [' %-16s %-50s %-5s %-10s %s'
+             % ('Name', 'Path', 'Type', 'Capacity', 'Allocation'),
+             '-' * 100]
+    for index in range(nb_volumes):
+        name = 'volume%d.qcow2' % index
+        lines.append(' %-16s %-50s %-5s %-10s %s'
+                     % (name, '/var/lib/libvirt/images/%s' % name, 'file',
+                        '20.00 GiB', '%d.%02d GiB' % (index % 20, index % 100)))
+    return lines
+
+def allocated(volume):
+    return kvm._size(*volume['allocation'].split())
+
+def memory(func):
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+def main():
+    nb_volumes = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    lines = vol_list(nb_volumes)
+    limit = 10 * 1024 ** 3
+    cases = (
+        ('dict', kvm._volumes,
+         lambda vols: sorted(vols.values(), key=allocated),
+         lambda vols: [vol for vol in vols.values() if allocated(vol) > limit]),
+        ('record', kvm._volume_records,
+         lambda vols: sorted(vols.values(), key=lambda vol: vol.allocation),
+         lambda vols: [vol for vol in vols.values() if vol.allocation > limit]),
+    )
+
+    print('%d volumes' % nb_volumes)
+    print('%-8s %12s %12s %12s %12s' % ('result', 'parse (ms)', 'memory (KiB)',
+                                        'sort (ms)', 'filter (ms)'))
+    for name, parse, sort, filter_ in cases:
+        volumes = parse(lines)
+        number = 5
+        print('%-8s %12.1f %12.1f %12.1f %12.1f'
+              % (name,
+                 timeit.timeit(lambda: parse(lines), number=number) / number * 1000,
+                 memory(lambda: parse(lines)) / 1024.,
+                 timeit.timeit(lambda: sort(volumes), number=number) / number * 1000,
+                 timeit.timeit(lambda: filter_(volumes), number=number) / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Benchmark of the conversion of XML configurations to dictionnaries (and
+back). The previous (recursive) implementation of ``from_xml`` is kept here as
+a reference for checking outputs and measuring the speedup.
+
+Usage: python benchmarks/bench_xml.py [NB_DISKS] [NB_INTERFACES]
+"""
+
+import os
+import sys
+import timeit
+from collections import OrderedDict
+import lxml.etree as etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import kvm
+from samples import domain_xml
+
+
+def reference_from_xml(elt, force_lists=[]):
+    tag = elt.tag
+    attrs = elt.items()
+    text = elt.text.strip() if elt.text else None
+    childs = list(elt)
+
+    if not attrs and not childs and not text:
+        value = True
+    elif not attrs and not childs and text:
+        value = text
+    elif attrs and not childs:
+        child = {'@%s' % attr: value for attr, value in attrs}
+        if text:
+            child['#text'] = text
+        value = child
+    elif childs:
+        elts = (OrderedDict(('@%s' % attr, value) for attr, value in attrs)
+                if attrs else OrderedDict())
+        for child in childs:
+            child = reference_from_xml(child, force_lists)
+            child_tag = list(child.keys())[0]
+            if child_tag not in elts and child_tag in force_lists:
+                elts[child_tag] = []
+            if child_tag  in elts:
+                if not isinstance(elts[child_tag], list):
+                    elts[child_tag] = [elts[child_tag]]
+                elts[child_tag].append(child[child_tag])
+            else:
+                elts.update(child)
+        value = elts
+
+    result = OrderedDict()
+    result[tag] = value
+    return result
+
+def reference_to_xml(tag_name, conf):
+    def parse(tag_name, conf):
+        tag = etree.Element(tag_name)
+        for elt, value in conf.items():
+            if elt.startswith('@'):
+                tag.attrib[elt[1:]] = str(value)
+            elif elt == '#text':
+                tag.text = str(value)
+            elif isinstance(value, dict):
+                tag.append(parse(elt, value))
+            elif isinstance(value, list):
+                for child in value:
+                    tag.append(parse(elt, child))
+            elif isinstance(value, bool):
+                tag.append(etree.Element(elt))
+                continue
+            else:
+                child = etree.Element(elt)
+                child.text = value
+                tag.append(child)
+        return tag
+    return etree.tostring(parse(tag_name, conf), pretty_print=True).decode()
+
+
+def bench(name, func, number):
+    duration = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print('%-24s %10.1f us/call' % (name, duration * 1e6))
+    return duration
+
+def main():
+    nb_disks = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    nb_interfaces = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    xml = domain_xml(nb_disks, nb_interfaces)
+    elt = etree.fromstring(xml)
+    lists = ['disk', 'interface']
+    number = 50
+
+    print('domain XML: %d disks, %d interfaces, %d bytes'
+          % (nb_disks, nb_interfaces, len(xml)))
+    conf = kvm.from_xml(elt, lists)
+    assert conf == reference_from_xml(elt, lists), 'from_xml outputs differ'
+    assert (kvm.to_xml('domain', conf['domain'])
+            == reference_to_xml('domain', conf['domain'])), 'to_xml outputs differ'
+
+    reference = bench('reference from_xml', lambda: reference_from_xml(elt, lists), number)
+    current = bench('from_xml', lambda: kvm.from_xml(elt, lists), number)
+    print('%-24s %10.2fx' % ('speedup', reference / current))
+    reference = bench('reference to_xml',
+                      lambda: reference_to_xml('domain', conf['domain']), number)
+    current = bench('to_xml', lambda: kvm.to_xml('domain', conf['domain']), number)
+    print('%-24s %10.2fx' % ('speedup', reference / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Samples of outputs of virsh commands used by benchmarks."""
+
+DISK = """    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2' cache='none' io='native'/>
+      <source file='/var/lib/libvirt/images/guest-disk%(index)d.qcow2'/>
+      <backingStore type='file'>
+        <format type='qcow2'/>
+        <source file='/var/lib/libvirt/images/base.qcow2'/>
+        <backingStore/>
+      </backingStore>
+      <target dev='vd%(index)d' bus='virtio'/>
+      <iotune>
+        <total_iops_sec>2000</total_iops_sec>
+      </iotune>
+      <alias name='virtio-disk%(index)d'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x%(index)02x' function='0x0'/>
+    </disk>
+"""
+
+INTERFACE = """    <interface type='bridge'>
+      <mac address='52:54:00:12:34:%(index)02x'/>
+      <source bridge='br%(index)d'/>
+      <target dev='vnet%(index)d'/>
+      <model type='virtio'/>
+      <driver name='vhost' queues='4'/>
+      <alias name='net%(index)d'/>
+      <address type='pci' domain='0x0000' bus='0x01' slot='0x%(index)02x' function='0x0'/>
+    </interface>
+"""
+
+DOMAIN = """<domain type='kvm' id='42'>
+  <name>guest1</name>
+  <uuid>ed68d942-5d4b-7bba-4d74-7d44d73779d3</uuid>
+  <title>Benchmark guest</title>
+  <memory unit='KiB'>16777216</memory>
+  <currentMemory unit='KiB'>16777216</currentMemory>
+  <vcpu placement='static'>16</vcpu>
+  <os>
+    <type arch='x86_64' machine='pc-i440fx-2.0'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+    <pae/>
+  </features>
+  <cpu mode='host-model'>
+    <model fallback='allow'/>
+    <topology sockets='2' cores='4' threads='2'/>
+  </cpu>
+  <clock offset='utc'/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>restart</on_crash>
+  <devices>
+    <emulator>/usr/bin/kvm-spice</emulator>
+%(disks)s%(interfaces)s    <serial type='pty'>
+      <source path='/dev/pts/3'/>
+      <target port='0'/>
+    </serial>
+    <graphics type='vnc' port='5900' autoport='yes' listen='127.0.0.1'>
+      <listen type='address' address='127.0.0.1'/>
+    </graphics>
+    <memballoon model='virtio'/>
+  </devices>
+  <seclabel type='dynamic' model='apparmor' relabel='yes'>
+    <label>libvirt-ed68d942-5d4b-7bba-4d74-7d44d73779d3</label>
+  </seclabel>
+</domain>
+"""
+
+def domain_xml(nb_disks, nb_interfaces):
+    return DOMAIN % {
+        'disks': ''.join(DISK % {'index': index} for index in range(nb_disks)),
+        'interfaces': ''.join(INTERFACE % {'index': index}
+                              for index in range(nb_interfaces))}
@@ -2,13 +2,16 @@
 
 import os
 import re
-import json
 import random
+import signal
 import string
 import weakref
+import threading
+import importlib
 import unix
-import lxml.etree as etree
 from collections import OrderedDict
+from contextlib import contextmanager
+from enum import Enum
 from datetime import datetime
 
 import sys
@@ -22,15 +25,49 @@ _BUILTINS = sys.modules['builtins'
 _CONTROLS = {'parse': False, 'ignore_opts': []}
 unix._CONTROLS.update(_CONTROLS)
 
+# Dictionnary keeping order of XML elements (dictionnaries are ordered from
+# python 3.7).
+_XmlDict = dict if sys.version_info >= (3, 7) else OrderedDict
+_MISSING = object()
+
 # Characters in generating strings.
 _CHOICES = string.ascii_letters[:6] + string.digits
 
 _ITEM_RE = re.compile('^.IX (?P<type>\w+) "(?P<value>.*)"$')
 
 __MAPFILE = os.path.join(os.path.dirname(__file__), 'kvm.json')
-_MAPPING = json.loads(''.join([line
-                               for line in open(__MAPFILE).readlines()
-                               if not line.startswith('#')]))
+
+def _load_mapping(mapfile=__MAPFILE):
+    """Load the mapping of virsh commands from **mapfile**."""
+    import json
+    with open(mapfile) as fhandler:
+        return json.loads(''.join(line
+                                  for line in fhandler
+                                  if not line.startswith('#')))
+
+_MAPPING = _load_mapping()
+
+
+class _LazyModule(object):
+    """Module imported on first access to one of its attributes. The module
+    then replaces the proxy in the global **global_name** of this module, so
+    next accesses cost nothing."""
+    def __init__(self, name, global_name):
+        self._name = name
+        self._global_name = global_name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            setattr(_SELF, self._global_name, self._module)
+        return getattr(self._module, attr)
+
+# lxml is only needed for XML configurations.
+etree = _LazyModule('lxml.etree', 'etree')
+
+# Groups of statistics of the 'domstats' command.
+_DOMSTATS_GROUPS = ('state', 'cpu_total', 'balloon', 'vcpu', 'interface', 'block')
 
 RUNNING = 'running'
 IDLE = 'idle'
@@ -53,79 +90,86 @@ def pprint(value):
 # Functions for generating datas.
 #
 def gen_uuid():
-    """Generate a random uuid."""
-    return '-'.join((''.join([random.choice(_CHOICES) for _ in range(0, 8)]),
-                     ''.join([random.choice(_CHOICES) for _ in range(0, 4)]),
-                     ''.join([random.choice(_CHOICES) for _ in range(0, 4)]),
-                     ''.join([random.choice(_CHOICES) for _ in range(0, 4)]),
-                     ''.join([random.choice(_CHOICES) for _ in range(0, 12)])))
+    """Generate a random (version 4) uuid. Use an ``IdAllocator`` for
+    uuids not used by existing domains."""
+    import uuid
+    return str(uuid.uuid4())
 
 def gen_mac():
-    """Generate a random mac address."""
-    return ':'.join(('54', '52', '00',
-                     ''.join([random.choice(_CHOICES) for _ in range(0, 2)]),
-                     ''.join([random.choice(_CHOICES) for _ in range(0, 2)]),
-                     ''.join([random.choice(_CHOICES) for _ in range(0, 2)])))
+    """Generate a random mac address. Use an ``IdAllocator`` for addresses
+    not used by existing domains."""
+    return _format_mac((0x54, 0x52, 0x00), random.getrandbits(24))
+
+def _format_mac(prefix, bits):
+    """Return the mac address made of the 3 octets of **prefix** and the 24
+    **bits**."""
+    return '%02x:%02x:%02x:%02x:%02x:%02x' % (prefix[0], prefix[1], prefix[2],
+                                              bits >> 16, (bits >> 8) & 0xff,
+                                              bits & 0xff)
 
 def from_xml(elt, force_lists=[]):
-    """Recursive function that transform an XML element to a dictionnary.
-    **elt** must be of type ``lxml.etree.Element``."""
-    tag = elt.tag
+    """Transform an XML element to a dictionnary. **elt** must be of type
+    ``lxml.etree.Element``. Attributes are prefixed by ``@`` and the text of
+    elements having attributes is put in the ``#text`` key. Tags in
+    **force_lists** are always put in a list."""
+    result = _XmlDict()
+    result[elt.tag] = _xml_value(elt, force_lists)
+    return result
+
+def _xml_value(elt, force_lists):
+    text = elt.text
+    if text:
+        text = text.strip()
     attrs = elt.items()
-    text = elt.text.strip() if elt.text else None
-    childs = elt.getchildren()
-
-    if not attrs and not childs and not text:
-        value = True
-    elif not attrs and not childs and text:
-        value = text
-    elif attrs and not childs:
-        child = {'@%s' % attr: value for attr, value in attrs}
-        if text:
-            child['#text'] = text
-        value = child
-    elif childs:
-        elts = (OrderedDict(('@%s' % attr, value) for attr, value in attrs)
-                if attrs else OrderedDict())
-        for child in childs:
-            child = from_xml(child, force_lists)
-            child_tag = list(child.keys())[0]
-            if child_tag not in elts and child_tag in force_lists:
-                elts[child_tag] = []
-            if child_tag  in elts:
-                if not isinstance(elts[child_tag], list):
-                    elts[child_tag] = [elts[child_tag]]
-                elts[child_tag].append(child[child_tag])
-            else:
-                elts.update(child)
-        value = elts
 
-    result = OrderedDict()
-    result[tag] = value
-    return result
+    if not len(elt):
+        if not attrs:
+            return text or True
+        value = {'@' + attr: attr_value for attr, attr_value in attrs}
+        if text:
+            value['#text'] = text
+        return value
+
+    value = _XmlDict(('@' + attr, attr_value) for attr, attr_value in attrs)
+    get = value.get
+    for child in elt:
+        tag = child.tag
+        if not isinstance(tag, str):
+            # Comments and processing instructions.
+            continue
+        child_value = _xml_value(child, force_lists)
+        current = get(tag, _MISSING)
+        if current is _MISSING:
+            value[tag] = [child_value] if tag in force_lists else child_value
+        elif type(current) is list:
+            current.append(child_value)
+        else:
+            value[tag] = [current, child_value]
+    return value
 
 def to_xml(tag_name, conf):
-    def parse(tag_name, conf):
-        tag = etree.Element(tag_name)
+    def add(parent, tag_name, value):
+        if isinstance(value, dict):
+            parse(etree.SubElement(parent, tag_name), value)
+        elif isinstance(value, list):
+            for child in value:
+                add(parent, tag_name, child)
+        elif isinstance(value, bool):
+            etree.SubElement(parent, tag_name)
+        else:
+            etree.SubElement(parent, tag_name).text = value
+
+    def parse(tag, conf):
         for elt, value in conf.items():
-            if elt.startswith('@'):
-                tag.attrib[elt[1:]] = str(value)
+            if elt[0] == '@':
+                tag.set(elt[1:], value if isinstance(value, str) else str(value))
             elif elt == '#text':
-                tag.text = str(value)
-            elif isinstance(value, dict):
-                tag.append(parse(elt, value))
-            elif isinstance(value, list):
-                for child in value:
-                    tag.append(parse(elt, child))
-            elif isinstance(value, bool):
-                tag.append(etree.Element(elt))
-                continue
+                tag.text = value if isinstance(value, str) else str(value)
             else:
-                child = etree.Element(elt)
-                child.text = value
-                tag.append(child)
+                add(tag, elt, value)
         return tag
-    return etree.tostring(parse(tag_name, conf), pretty_print=True).decode()
+    return etree.tostring(parse(etree.Element(tag_name), conf),
+                          pretty_print=True).decode()
 
 def _dict(lines):
     def format_key(key):
@@ -155,18 +199,188 @@ def _list(lines):
     params = [param.lower() for param in re.split('\s+', lines[0])][1:]
     return [dict(zip(params, re.split('\s+', line)[1:])) for line in lines[2:]]
 
-def __add_method(obj, method, conf):
+def _domstats(records):
+    """Transform ``domstats`` records (tuples with the name of the domain and
+    a dictionnary of flat ``group.[index.]key`` statistics) to a dictionnary
+    indexed by domain, group and device. Devices of ``net`` and ``block``
+    groups are indexed by their name and vcpus by their number."""
+    result = {}
+    for domain, flat_stats in records:
+        stats = result.setdefault(domain, {})
+        names = {tuple(key.split('.')[:2]): value
+                 for key, value in flat_stats.items()
+                 if key.count('.') == 2 and key.endswith('.name')}
+        for key, value in flat_stats.items():
+            group, _, key = key.partition('.')
+            index, _, device_key = key.partition('.')
+            if index.isdigit() and device_key:
+                device = names.get((group, index), int(index))
+                device_stats = stats.setdefault(group, {}).setdefault(device, {})
+                if device_key != 'name':
+                    device_stats[device_key.replace('.', '_')] = _typed(value)
+            elif key != 'count':
+                stats.setdefault(group, {})[key.replace('.', '_')] = _typed(value)
+    return result
+
+def _domstats_records(lines):
+    domain = None
+    stats = {}
+    for line in lines:
+        line = line.strip()
+        if line.startswith('Domain:'):
+            if domain is not None:
+                yield domain, stats
+            domain, stats = line.split(':', 1)[1].strip().strip("'"), {}
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            stats[key] = value
+    if domain is not None:
+        yield domain, stats
+
+def _typed(value):
+    if isinstance(value, str) and value.lstrip('-').isdigit():
+        return int(value)
+    return value
+
+def _domains_options(kwargs):
+    """Return options of the ``list`` command for **kwargs** of
+    ``list_domains``."""
+    # Remove incompatible options between virsh versions.
+    kwargs.pop('name', None)
+    kwargs.pop('uuid', None)
+
+    # Get states argument (which is not an option of the virsh command).
+    states = kwargs.pop('states', [])
+    if states:
+        kwargs['all'] = True
+
+    # Add virsh options for kwargs.
+    return {arg: value for arg, value in kwargs.items() if value}
+
+def _domains(lines, title=False):
+    return dict(_domain_row(line, title) for line in lines[2:])
+
+def _domain_row(line, title=False):
+    line = line.split()
+    (domid, name, state), params = line[:3], line[3:]
+    # Manage state in two words.
+    if state == 'shut':
+        state += ' %s' % params.pop(0)
+    domain = {'id': int(domid) if domid != '-' else -1,
+              'state': state}
+    if title:
+        domain['title'] = ' '.join(params) if params else ''
+    return name, domain
+
+def _networks(lines):
+    networks = {}
+    for line in lines[2:]:
+        line = line.split()
+        name, state, autostart = line[:3]
+        net = dict(state=state, autostart=_convert(autostart))
+        if len(line) == 4:
+            net.update(persistent=_convert(line[3]))
+        networks.setdefault(name, net)
+    return networks
+
+def _interfaces(lines):
+    return {name: {'state': state, 'mac': mac}
+            for line in lines[2:]
+            for name, state, mac in [line.split()]}
+
+def _pools(lines):
+    pools = {}
+    for line in lines[2:]:
+        line = line.split()
+        name, state, autostart = line[:3]
+        pool = dict(state=state, autostart=_convert(autostart))
+        if len(line) > 3:
+            capacity, allocation, available = _pool_sizes(line[4:], ' '.join)
+            pool.update(persistent=_convert(line[3]), capacity=capacity,
+                        allocation=allocation, available=available)
+        pools.setdefault(line[0], pool)
+    return pools
+
+def _pool_sizes(fields, convert):
+    """Return the capacity, allocation and available sizes in the **fields**
+    of a pool, converted by **convert** from the value and unit of a size.
+    Sizes of inactive pools are printed as ``-`` and returned as ``None``."""
+    fields, sizes = iter(fields), []
+    for value in fields:
+        sizes.append(None if value == '-' else convert((value, next(fields))))
+    return (sizes + [None] * 3)[:3]
+
+def _volumes(lines):
+    volumes = {}
+    for line in lines[2:]:
+        name, volume = _volume_row(line)
+        volumes.setdefault(name, volume)
+    return volumes
+
+def _volume_row(line):
+    line = line.split()
+    name, path = line[:2]
+    volume = dict(path=path)
+    if len(line) > 2:
+        volume.update(type=line[2],
+                      capacity=' '.join(line[3:5]),
+                      allocation=' '.join(line[5:7]))
+    return name, volume
+
+def _secrets(lines):
+    secrets = {}
+    for line in lines[2:]:
+        line = line.split()
+        uuid, usage = line[0], line[1:]
+        secrets.setdefault(uuid, ' '.join(usage))
+    return secrets
+
+def _snapshots(lines, parent=False):
+    snapshots = {}
+    for line in lines[2:]:
+        line = line.split()
+        creation_date = datetime.strptime(' '.join(line[1:4]),
+                                          '%Y-%m-%d %H:%M:%S %z')
+        state = line[4]
+        if state == 'shut':
+            state += line[5]
+            snapshot_parent = line[6] if parent else None
+        else:
+            snapshot_parent = line[5] if parent else None
+        snapshot = {'creation_date': creation_date, 'state': state}
+        if snapshot_parent and snapshot_parent != 'null':
+            snapshot.update(parent=snapshot_parent)
+        snapshots.setdefault(line[0], snapshot)
+    return snapshots
+
+def _parse(conf, lines):
+    """Parse output **lines** of a command according to its configuration in
+    the mapping."""
+    if conf['type'] == 'str':
+        result = lines[0]
+        if 'convert' in conf:
+            try:
+                return getattr(_BUILTINS, conf['convert'])(result)
+            except ValueError:
+                return -1 if conf['convert'] == 'int' else result
+        return result
+    elif conf['type'] in ('dict', 'tune'):
+        return _dict(lines)
+    elif conf['type'] == 'stats':
+        return _stats(lines, conf.get('ignore', False))
+    elif conf['type'] == 'list':
+        return _list(lines)
+    elif conf['type'] == 'xml':
+        return from_xml(etree.fromstring('\n'.join(lines)),
+                        conf.get('lists', []))[conf['key']]
+    return lines
+
+def __add_method(obj, group, method, conf):
     cmd = conf.get('cmd', method)
-    ignore_opts = conf.pop('disable', [])
+    ignore_opts = conf.get('disable', [])
     def str_method(self, *args, **kwargs):
         with self._host.set_controls(parse=True, ignore_opts=ignore_opts):
-            result = self._host.virsh(cmd, *args, **kwargs)[0]
-            if 'convert' in conf:
-                try:
-                    return getattr(_BUILTINS, conf['convert'])(result)
-                except ValueError:
-                    return -1 if conf['convert'] == 'int' else result
-            return result
+            return _parse(conf, self._host.virsh(cmd, *args, **kwargs))
 
     def dict_method(self, *args, **kwargs):
         with self._host.set_controls(parse=True, ignore_opts=ignore_opts):
@@ -174,13 +388,12 @@ def __add_method(obj, method, conf):
 
     def stats_method(self, *args, **kwargs):
         with self._host.set_controls(parse=True, ignore_opts=ignore_opts):
-
-            return _stats(self._host.virsh(cmd, *args, **kwargs),
-                          conf.get('ignore', False))
+            return _parse(conf, self._host.virsh(cmd, *args, **kwargs))
 
     def list_method(self, *args, **kwargs):
         with self._host.set_controls(parse=True, ignore_opts=ignore_opts):
-            return _list(self._host.virsh(cmd, *args, **kwargs))
+            lines = self._host.virsh(cmd, *args, **kwargs)
+        return (_list_records if self._host._typed else _list)(lines)
 
     def tune_method(self, *args, **kwargs):
         ignore_opts = ('config', 'live', 'current')
@@ -191,14 +404,23 @@ def __add_method(obj, method, conf):
             return none_method(self, *args, **kwargs)
 
     def none_method(self, *args, **kwargs):
-        return self._host.virsh(cmd, *args, **kwargs)
+        result = self._host.virsh(cmd, *args, **kwargs)
+        if self._host._cache is not None:
+            # Objects are given by a file when created or defined.
+            create = method.startswith(('create', 'define'))
+            self._host._cache.invalidate(group,
+                                         None if create or not args else args[0])
+        return result
 
     def xml_method(self, *args, **kwargs):
         with self._host.set_controls(parse=True, ignore_opts=ignore_opts):
-            xml = '\n'.join(self._host.virsh(cmd, *args, **kwargs))
-        return from_xml(etree.fromstring(xml), conf.get('lists', []))[conf['key']]
+            lines = self._host.virsh(cmd, *args, **kwargs)
+        return _parse(conf, lines)
 
-    setattr(obj, method.replace('-', '_'), locals()['%s_method' % conf['type']])
+    func = locals()['%s_method' % conf['type']]
+    if conf['type'] not in ('none', 'tune'):
+        func = _cached('%s.%s' % (group, method))(func)
+    setattr(obj, method.replace('-', '_'), func)
 
 def _convert(value):
     value = value.strip()
@@ -210,6 +432,223 @@ def _convert(value):
     return value
 
 
+#
+# Typed records.
+#
+class DomainState(str, Enum):
+    """States of domains (members are equal to the strings printed by virsh)."""
+    RUNNING = RUNNING
+    IDLE = IDLE
+    PAUSED = PAUSED
+    SHUTDOWN = SHUTDOWN
+    SHUTOFF = SHUTOFF
+    CRASHED = CRASHED
+    DYING = DYING
+    SUSPENDED = SUSPENDED
+    __str__ = str.__str__
+
+class PoolState(str, Enum):
+    """States of storage pools (active pools are ``running`` with the
+    *details* option)."""
+    ACTIVE = 'active'
+    RUNNING = 'running'
+    INACTIVE = 'inactive'
+    BUILDING = 'building'
+    DEGRADED = 'degraded'
+    INACCESSIBLE = 'inaccessible'
+    __str__ = str.__str__
+
+# Other names of states printed by virsh.
+_STATES_ALIASES = {'in shutdown': SHUTDOWN, 'shutoff': SHUTOFF}
+
+# Multipliers of units of sizes printed by virsh.
+_SIZE_UNITS = {unit: 1024 ** power
+               for power, unit in enumerate(('B', 'KiB', 'MiB', 'GiB', 'TiB',
+                                             'PiB', 'EiB'))}
+_SIZE_UNITS['bytes'] = 1
+
+def _state(enum, value):
+    """Return the member of **enum** for the state **value** (or **value** for
+    unknown states)."""
+    try:
+        return enum(_STATES_ALIASES.get(value, value))
+    except ValueError:
+        return value
+
+def _size(value, unit):
+    """Convert a size printed by virsh (like ``10.00 GiB``) to bytes."""
+    return int(round(float(value) * _SIZE_UNITS[unit]))
+
+class _Record(object):
+    """Base class of records returned by the ``list_*`` methods of typed
+    hypervisors. Fields are stored in slots, so records are smaller than
+    dictionnaries, and records can also be read like dictionnaries
+    (``record['state']``) with unset fields (``None``) excluded."""
+    __slots__ = ()
+    __hash__ = None
+
+    def __init__(self, *args, **kwargs):
+        values = dict(zip(self.__slots__, args), **kwargs)
+        for field in self.__slots__:
+            setattr(self, field, values.get(field))
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (_Record, dict)):
+            return self.as_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (field, getattr(self, field))
+                                     for field in self.__slots__))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [field for field in self.__slots__
+                if getattr(self, field) is not None]
+
+    def values(self):
+        return [getattr(self, field) for field in self.keys()]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def as_dict(self):
+        return dict(self.items())
+
+class Domain(_Record):
+    __slots__ = ('name', 'id', 'state', 'title')
+
+    def __init__(self, name, id, state, title=None):
+        self.name, self.id, self.state, self.title = name, id, state, title
+
+class Pool(_Record):
+    __slots__ = ('name', 'state', 'autostart', 'persistent', 'capacity',
+                 'allocation', 'available')
+
+    def __init__(self, name, state, autostart, persistent=None, capacity=None,
+                 allocation=None, available=None):
+        self.name, self.state, self.autostart = name, state, autostart
+        self.persistent, self.capacity = persistent, capacity
+        self.allocation, self.available = allocation, available
+
+class Volume(_Record):
+    __slots__ = ('name', 'path', 'type', 'capacity', 'allocation')
+
+    def __init__(self, name, path, type=None, capacity=None, allocation=None):
+        self.name, self.path, self.type = name, path, type
+        self.capacity, self.allocation = capacity, allocation
+
+class Snapshot(_Record):
+    __slots__ = ('name', 'creation_date', 'state', 'parent')
+
+    def __init__(self, name, creation_date, state, parent=None):
+        self.name, self.creation_date = name, creation_date
+        self.state, self.parent = state, parent
+
+# Classes of records of the 'list' type commands indexed by their fields.
+_RECORDS = {}
+
+def _domain_records(lines, title=False):
+    return dict(_domain_record_row(line, title) for line in lines[2:])
+
+def _domain_record_row(line, title=False):
+    line = line.split()
+    (domid, name, state), params = line[:3], line[3:]
+    # Manage states in two words.
+    if state in ('shut', 'in'):
+        state += ' %s' % params.pop(0)
+    return name, Domain(name, int(domid) if domid != '-' else -1,
+                        _state(DomainState, state),
+                        ' '.join(params) if title else None)
+
+def _pool_records(lines):
+    pools = {}
+    for line in lines[2:]:
+        line = line.split()
+        name = line[0]
+        if name in pools:
+            continue
+        pool = Pool(name, _state(PoolState, line[1]), _convert(line[2]))
+        if len(line) > 3:
+            pool.persistent = _convert(line[3])
+            pool.capacity, pool.allocation, pool.available = _pool_sizes(
+                line[4:], lambda size: _size(*size))
+        pools[name] = pool
+    return pools
+
+def _volume_records(lines):
+    volumes = {}
+    # Sizes are often the same, so conversions are memoized.
+    sizes = {}
+    def size(value, unit):
+        try:
+            return sizes[value, unit]
+        except KeyError:
+            sizes[value, unit] = _size(value, unit)
+            return sizes[value, unit]
+
+    for line in lines[2:]:
+        name, volume = _volume_record_row(line, size)
+        volumes.setdefault(name, volume)
+    return volumes
+
+def _volume_record_row(line, size=_size):
+    line = line.split()
+    name = line[0]
+    return name, (Volume(name, line[1], line[2], size(line[3], line[4]),
+                         size(line[5], line[6]))
+                  if len(line) > 2
+                  else Volume(name, line[1]))
+
+def _snapshot_records(lines, parent=False):
+    snapshots = {}
+    for line in lines[2:]:
+        line = line.split()
+        name = line[0]
+        if name in snapshots:
+            continue
+        creation_date = datetime.strptime(' '.join(line[1:4]),
+                                          '%Y-%m-%d %H:%M:%S %z')
+        state, params = line[4], line[5:]
+        if state in ('shut', 'in'):
+            state += ' %s' % params.pop(0)
+        snapshot_parent = params[0] if parent and params else None
+        snapshots[name] = Snapshot(name, creation_date,
+                                   _state(DomainState, state),
+                                   snapshot_parent
+                                   if snapshot_parent != 'null' else None)
+    return snapshots
+
+def _list_records(lines):
+    fields = tuple(param.lower() for param in re.split('\s+', lines[0])[1:])
+    if fields not in _RECORDS:
+        _RECORDS[fields] = type('Record', (_Record,), {'__slots__': fields})
+    record = _RECORDS[fields]
+    return [record(*re.split('\s+', line)[1:]) for line in lines[2:]]
+
+
 #
 # Exceptions
 #
@@ -222,27 +661,1157 @@ class TimeoutException(Exception):
     pass
 
 
+#
+# Cache.
+#
+# Time to live of results of methods not in the mapping.
+_CACHE_TTLS = {'list_networks': 60,
+               'list_interfaces': 60,
+               'list_pools': 60,
+               'list_volumes': 60,
+               'list_secrets': 60,
+               'hypervisor.sysinfo': 3600}
+
+# Groups of methods whose results depend on objects of another group.
+_CACHE_DEPENDENCIES = {'domain': ('snapshot',), 'pool': ('volume',)}
+
+class _Cache(object):
+    """LRU cache, limited to **size** entries, of the results of methods.
+    **ttls** is a dictionnary with the time to live (in seconds) of methods
+    results. Methods are named ``<group>.<method>`` (like ``domain.conf``) or
+    ``list_<group>s``. Results of methods without time to live are not
+    cached."""
+    def __init__(self, ttls, size=1024):
+        self.ttls = ttls
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, args, kwargs, func):
+        """Return the cached result for method **name** called with **args**
+        and **kwargs**, calling **func** if there is no valid result."""
+        import copy
+        import time
+
+        ttl = self.ttls.get(name)
+        try:
+            key = (name, args, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            ttl = None
+        if not ttl:
+            return func()
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self._entries[key] = entry
+                return copy.deepcopy(entry[1])
+
+        result = func()
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, result)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return copy.deepcopy(result)
+
+    def invalidate(self, group, obj=None):
+        """Remove cached results of methods of **group** for the object
+        **obj** (all objects if not set), the results of the methods depending
+        on them and the list of objects of **group**."""
+        with self._lock:
+            for key in list(self._entries):
+                name, args = key[:2]
+                key_group = name.split('.')[0]
+                dependencies = _CACHE_DEPENDENCIES.get(group, ())
+                if (name in ['list_%ss' % elt for elt in (group,) + dependencies]
+                  or key_group in dependencies
+                  or (key_group == group
+                      and (obj is None or args[:1] == (obj,)))):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def _cached(name):
+    """Decorator caching results of method **name** when the cache of the
+    hypervisor is enabled."""
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            host = getattr(self, '_host', self)
+            if host._cache is None:
+                return func(self, *args, **kwargs)
+            return host._cache.get(name, args, kwargs,
+                                   lambda: func(self, *args, **kwargs))
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+#
+# Instrumentation.
+#
+# Hooks called for all hypervisors.
+_HOOKS = []
+
+def add_hook(hook):
+    """Add **hook** (an object of type ``Hook``) for the commands executed on
+    all hypervisors."""
+    _HOOKS.append(hook)
+
+def remove_hook(hook):
+    _HOOKS.remove(hook)
+
+def _hooked(host, command, args, kwargs, func):
+    """Execute **func** (which returns the status, stdout and stderr of
+    **command**) calling the hooks of **host** before and after it."""
+    hooks, call = _pre_hooks(host, command, args, kwargs)
+    if not hooks:
+        return func()
+
+    try:
+        result = func()
+    except Exception as err:
+        _post_hooks(hooks, call, False, 0, len(str(err)))
+        raise
+    status, stdout, stderr = result
+    size = lambda output: len(output) if isinstance(output, (str, bytes)) else 0
+    _post_hooks(hooks, call, status, size(stdout), size(stderr))
+    return result
+
+def _pre_hooks(host, command, args, kwargs):
+    """Call the ``pre`` method of the hooks of **host** for **command**.
+    Return the hooks and the call given to them (``None`` without hooks)."""
+    import time
+
+    hooks = _HOOKS + host._hooks
+    if not hooks:
+        return hooks, None
+
+    tool, _, subcommand = command.partition(' ')
+    call = {'tool': tool,
+            'command': subcommand or tool,
+            'args': args,
+            'kwargs': kwargs,
+            'host': _hostname(host)}
+    for hook in hooks:
+        hook.pre(call)
+    call['start'] = time.time()
+    return hooks, call
+
+def _post_hooks(hooks, call, status, stdout_size, stderr_size):
+    """Call the ``post`` method of **hooks** at the end of **call**."""
+    import time
+    call.update(duration=time.time() - call.pop('start'),
+                status=status,
+                stdout_size=stdout_size,
+                stderr_size=stderr_size)
+    for hook in hooks:
+        hook.post(call)
+
+class Hook(object):
+    """Base class of hooks called around the execution of ``virsh`` and
+    ``qemu-img`` commands. **pre** is called before the execution with a
+    dictionnary containing the *tool* (``virsh``, ``qemu-img``), the
+    *command*, its *args* and *kwargs* and the *host*. **post** is called
+    after the execution with the same dictionnary completed with the
+    *duration* (in seconds), the *status* and the size of *stdout* and
+    *stderr* (*stdout_size* and *stderr_size*)."""
+    def pre(self, call):
+        pass
+
+    def post(self, call):
+        pass
+
+class Histogram(Hook):
+    """Hook keeping in memory a histogram of durations (with **buckets** the
+    upper bounds, in seconds, of the buckets) per tool, command and host."""
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def post(self, call):
+        import bisect
+        key = (call['tool'], call['command'], call['host'])
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = {'count': 0,
+                                               'errors': 0,
+                                               'sum': 0.,
+                                               'output_bytes': 0,
+                                               'buckets': [0] * (len(self.buckets) + 1)}
+            metric['count'] += 1
+            metric['errors'] += 0 if call['status'] else 1
+            metric['sum'] += call['duration']
+            metric['output_bytes'] += call['stdout_size']
+            metric['buckets'][bisect.bisect_left(self.buckets, call['duration'])] += 1
+
+    def stats(self):
+        """Return a dictionnary indexed by tool, command and host with the
+        number of calls (*count*), the number of calls in error (*errors*),
+        the total duration (*sum*), the size of outputs (*output_bytes*) and
+        the number of calls per bucket (*buckets*, the last bucket is for
+        durations greater than the upper bound of the last bucket)."""
+        with self._lock:
+            return {key: dict(metric, buckets=list(metric['buckets']))
+                    for key, metric in self._metrics.items()}
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def openmetrics(self, prefix='kvm_command'):
+        """Export the histogram in the OpenMetrics (Prometheus) text
+        format."""
+        def labels(tool, command, host, **others):
+            values = [('tool', tool), ('command', command), ('host', host)]
+            values.extend(sorted(others.items()))
+            return ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\')
+                                                          .replace('"', '\\"'))
+                            for label, value in values)
+
+        lines = ['# TYPE %s_duration_seconds histogram' % prefix,
+                 '# UNIT %s_duration_seconds seconds' % prefix]
+        stats = self.stats()
+        for key, metric in sorted(stats.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), metric['buckets']):
+                cumulative += count
+                lines.append('%s_duration_seconds_bucket{%s} %d'
+                             % (prefix, labels(*key, le=bound), cumulative))
+            lines.append('%s_duration_seconds_count{%s} %d'
+                         % (prefix, labels(*key), metric['count']))
+            lines.append('%s_duration_seconds_sum{%s} %f'
+                         % (prefix, labels(*key), metric['sum']))
+        for name, field in (('errors', 'errors'), ('output_bytes', 'output_bytes')):
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            lines.extend('%s_%s_total{%s} %d' % (prefix, name, labels(*key), metric[field])
+                         for key, metric in sorted(stats.items()))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+class LogHook(Hook):
+    """Hook logging each command, with its informations in the ``kvm`` field
+    of the record, on **logger** (the ``kvm`` logger by default)."""
+    def __init__(self, logger=None, level=None):
+        import logging
+        self.logger = logger or logging.getLogger('kvm')
+        self.level = level if level is not None else logging.INFO
+
+    def post(self, call):
+        self.logger.log(self.level,
+                        '%s %s on %s: status=%s duration=%.3fs stdout=%dB',
+                        call['tool'], call['command'], call['host'],
+                        call['status'], call['duration'], call['stdout_size'],
+                        extra={'kvm': dict(call)})
+
+
+#
+# Processes.
+#
+def _format_args(args, kwargs):
+    """Format arguments and options of a command the same way ``unix`` does
+    when options are put after arguments."""
+    command = [str(arg) for arg in args]
+    for option, value in kwargs.items():
+        option = ('-%s' % option
+                  if len(option) == 1
+                  else '--%s' % option.replace('_', '-'))
+        if type(value) is bool:
+            if value:
+                command.append(option)
+        elif type(value) in (list, tuple, set):
+            command.extend('%s %s' % (option, val) for val in value)
+        else:
+            command.append('%s %s' % (option, value))
+    return ' '.join(command)
+
+class _LocalProcess(object):
+    """Process started on a ``unix.Local`` host with its standard streams
+    kept open."""
+    def __init__(self, command, decode):
+        import fcntl
+        import subprocess
+        self._decode = decode or 'utf-8'
+        # The command is run by a shell in its own process group, so closing
+        # the process also terminates the command.
+        session = ({'start_new_session': True} if sys.version_info >= (3, 2)
+                   else {'preexec_fn': os.setsid})
+        self._proc = subprocess.Popen(command,
+                                      shell=True,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      **session)
+        fd = self._proc.stderr.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # Bytes of stdout read but not returned yet by 'readline'.
+        self._buffer = b''
+
+    def alive(self):
+        return self._proc.poll() is None
+
+    def write(self, data):
+        self._proc.stdin.write(data.encode(self._decode))
+        self._proc.stdin.flush()
+
+    def readline(self, timeout=None):
+        """Read a line of stdout. **TimeoutException** is raised when no line
+        is read after **timeout** seconds."""
+        import time
+        import select
+        fd = self._proc.stdout.fileno()
+        deadline = time.time() + timeout if timeout is not None else None
+        while b'\n' not in self._buffer:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if (remaining <= 0
+                  or not select.select([fd], [], [], remaining)[0]):
+                    raise TimeoutException('no output after %ss' % timeout)
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            self._buffer += data
+        index = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:index], self._buffer[index:]
+        return line.decode(self._decode)
+
+    def read(self, size=4096):
+        """Read at most **size** bytes of stdout (as soon as some bytes are
+        available), an empty string is returned at the end of stdout."""
+        if self._buffer:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data.decode(self._decode)
+        return os.read(self._proc.stdout.fileno(), size).decode(self._decode)
+
+    def read_stderr(self):
+        try:
+            return (self._proc.stderr.read() or b'').decode(self._decode)
+        except (IOError, OSError):
+            return ''
+
+    def wait(self):
+        self._proc.wait()
+        return self._proc.returncode
+
+    def close(self):
+        if self.alive():
+            try:
+                self._proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            try:
+                os.killpg(self._proc.pid, signal.SIGTERM)
+            except OSError:
+                self._proc.terminate()
+        self._proc.wait()
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+
+class _RemoteProcess(object):
+    """Process started on a ``unix.Remote`` host in its own SSH channel."""
+    def __init__(self, chan, decode):
+        self._decode = decode or 'utf-8'
+        self._chan = chan
+        self._stdout = chan.makefile('rb', -1)
+
+    def alive(self):
+        return not self._chan.closed and not self._chan.exit_status_ready()
+
+    def write(self, data):
+        self._chan.sendall(data.encode(self._decode))
+
+    def readline(self, timeout=None):
+        import socket
+        self._chan.settimeout(timeout)
+        try:
+            return self._stdout.readline().decode(self._decode)
+        except socket.timeout:
+            raise TimeoutException('no output after %ss' % timeout)
+        finally:
+            self._chan.settimeout(None)
+
+    def read(self, size=4096):
+        return self._chan.recv(size).decode(self._decode)
+
+    def read_stderr(self):
+        stderr = b''
+        while self._chan.recv_stderr_ready():
+            stderr += self._chan.recv_stderr(4096)
+        return stderr.decode(self._decode)
+
+    def wait(self):
+        return self._chan.recv_exit_status()
+
+    def close(self):
+        self._chan.close()
+
+def _spawn(host, command, *args, **kwargs):
+    """Start **command** on **host** without waiting for its end and return
+    an object giving access to its standard streams."""
+    command = host._format_command(command, args, kwargs)[0]
+    if unix.ishost(host, 'Remote'):
+        host.is_connected()
+        chan = host._conn.get_transport().open_session()
+        chan.exec_command(command)
+        return _RemoteProcess(chan, host._decode)
+    return _LocalProcess(command, host._decode)
+
+# Prompt printed by a virsh shell before reading a line.
+_PROMPT_RE = re.compile('^virsh [#>] ')
+
+class _Session(object):
+    """Interactive ``virsh`` shell kept open for executing commands without
+    starting a new process (and a new connection) each time. The end of the
+    output of a command is detected by echoing unique markers around it. As
+    the shell does not return the exit code of commands, a command is in error
+    when an ``error:`` line is written on stderr. The markers and the command
+    are sent on separate lines because virsh drops a whole line it can't
+    parse. When no output is read for **timeout** seconds, the shell is
+    closed (and restarted by the next command)."""
+    def __init__(self, host, uri, timeout=300):
+        self._host = host
+        self._uri = uri
+        self.timeout = timeout
+        self._proc = None
+        self._lock = threading.Lock()
+        self._count = 0
+        self._token = ''.join(random.choice(_CHOICES) for _ in range(0, 8))
+
+    def alive(self):
+        return self._proc is not None and self._proc.alive()
+
+    def start(self):
+        self.close()
+        with self._host.set_controls(options_place='after'):
+            self._proc = _spawn(self._host, 'virsh', connect=self._uri)
+
+    def close(self):
+        if self._proc is not None:
+            try:
+                self._proc.write('quit\n')
+            except (IOError, OSError):
+                pass
+            self._proc.close()
+            self._proc = None
+
+    def _send(self, line):
+        if not self.alive():
+            self.start()
+        try:
+            self._proc.write(line)
+        except (IOError, OSError):
+            # The shell died since the last command, the command has not been
+            # sent so it is safe to restart the shell and send it again.
+            self.start()
+            self._proc.write(line)
+
+    def execute(self, command, *args, **kwargs):
+        with self._lock:
+            self._count += 1
+            start = '__kvm_%s_%d_start__' % (self._token, self._count)
+            end = '__kvm_%s_%d_end__' % (self._token, self._count)
+            self._send('echo %s\n%s %s\necho %s\n'
+                       % (start, command, _format_args(args, kwargs), end))
+
+            # Skip everything before the start marker (prompt, echoed input).
+            started, lines = False, []
+            while True:
+                try:
+                    line = self._proc.readline(self.timeout)
+                except TimeoutException:
+                    self.close()
+                    return [False, '\n'.join(lines),
+                            'virsh session: no output after %ss' % self.timeout]
+                if not line:
+                    stderr = self._proc.read_stderr().rstrip('\n')
+                    self.close()
+                    return [False, '\n'.join(lines),
+                            stderr or 'virsh session terminated']
+                line = line.rstrip('\n')
+                if not started:
+                    started = line.endswith(start)
+                    first = True
+                    continue
+                if first:
+                    # virsh prints its prompt before reading the command.
+                    line, first = _PROMPT_RE.sub('', line, 1), False
+                if line.endswith(end):
+                    # The end marker is also echoed after a prompt.
+                    line = _PROMPT_RE.sub('', line[:-len(end)], 1)
+                    if line:
+                        lines.append(line)
+                    break
+                lines.append(line)
+
+            stderr = self._proc.read_stderr()
+            status = not any(line.startswith('error:')
+                             for line in stderr.splitlines())
+            return [status, '\n'.join(lines), stderr]
+
+class _SessionPool(object):
+    """Pool of at most **size** persistent ``virsh`` shells (see
+    ``_Session``). A shell executes one command at a time, so commands of
+    several threads are dispatched on different shells and executed in
+    parallel (for a ``unix.Remote`` host, each shell is a channel of the SSH
+    connection). When all shells are busy, commands wait for a shell to be
+    free. Shells are started when needed, closed when they are idle for more
+    than **max_idle** seconds and checked (with an ``echo`` command) before
+    being used when they are idle for more than **check_interval** seconds.
+    A shell writing no output for **timeout** seconds is closed.
+    """
+    def __init__(self, host, uri, size=1, max_idle=300, check_interval=60,
+                 timeout=300):
+        self._host = host
+        self._uri = uri
+        self.timeout = timeout
+        self.size = size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        # Idle shells with the time they were released (most recent last).
+        self._idle = []
+        self._busy = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._idle) + self._busy
+
+    def alive(self):
+        with self._cond:
+            return self._busy > 0 or any(session.alive()
+                                         for session, _ in self._idle)
+
+    def start(self):
+        """Start a shell (if none is started)."""
+        session = self._acquire()
+        try:
+            if not session.alive():
+                session.start()
+        finally:
+            self._release(session)
+
+    def close(self):
+        """Close idle shells (busy shells are closed when released)."""
+        with self._cond:
+            sessions, self._idle = self._idle, []
+        for session, _ in sessions:
+            session.close()
+
+    def _check(self, session):
+        status, stdout, _ = session.execute('echo', 'ping')
+        return status and stdout == 'ping'
+
+    def _acquire(self):
+        import time
+        with self._cond:
+            while True:
+                now = time.time()
+                # Evict shells idle for too long (the oldest are first).
+                evicted = []
+                while self._idle and now - self._idle[0][1] > self.max_idle:
+                    evicted.append(self._idle.pop(0)[0])
+                if self._idle:
+                    session, released = self._idle.pop()
+                    break
+                if self._busy < self.size:
+                    session = _Session(self._host, self._uri, self.timeout)
+                    released = None
+                    break
+                self._cond.wait()
+            self._busy += 1
+
+        for evicted_session in evicted:
+            evicted_session.close()
+        if (released is not None
+          and now - released > self.check_interval
+          and not self._check(session)):
+            session.start()
+        return session
+
+    def _release(self, session):
+        import time
+        with self._cond:
+            self._busy -= 1
+            keep = session.alive() and len(self._idle) + self._busy < self.size
+            if keep:
+                self._idle.append((session, time.time()))
+            self._cond.notify()
+        if not keep:
+            session.close()
+
+    def execute(self, command, *args, **kwargs):
+        session = self._acquire()
+        try:
+            return session.execute(command, *args, **kwargs)
+        finally:
+            self._release(session)
+
+# Regular expression for matching lifecycle events printed by 'virsh event'.
+_EVENT_RE = re.compile("event 'lifecycle' for domain '?(?P<domain>.+?)'?: "
+                       "(?P<event>\\w+)")
+
+# Domain states after lifecycle events (others events do not change state).
+_EVENT_STATES = {'Started': RUNNING,
+                 'Suspended': PAUSED,
+                 'Resumed': RUNNING,
+                 'Stopped': SHUTOFF,
+                 'PMSuspended': SUSPENDED,
+                 'Crashed': CRASHED}
+
+def _read_events(events_ref, proc):
+    """Read the lifecycle events printed by **proc** for the ``_Events``
+    object referenced by **events_ref**. The reference is weak so the thread
+    does not keep the listener (and its hypervisor) alive."""
+    while True:
+        try:
+            line = proc.readline()
+        except (IOError, OSError, ValueError):
+            # The process has been closed.
+            line = ''
+        events = events_ref()
+        if events is None:
+            return
+        if not line:
+            # Wake up waiters so they fall back to polling.
+            with events._cond:
+                events._cond.notify_all()
+            return
+        events._event(line)
+        del events
+
+class _Events(object):
+    """Listener of lifecycle events of domains. A ``virsh event`` process is
+    read in a thread which keeps the last state of each domain and wakes up
+    the threads waiting for a state. The process is closed when the listener
+    is closed or garbage collected."""
+    def __init__(self, host, uri):
+        self._host = host
+        self._uri = uri
+        self._proc = None
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._states = {}
+        # Last states polled, shared by waiting threads.
+        self._polled = {}
+        self._poll_time = 0
+        self._polling = False
+
+    def alive(self):
+        return self._proc is not None and self._proc.alive()
+
+    def start(self):
+        with self._cond:
+            if self.alive():
+                return
+            with self._host.set_controls(options_place='after'):
+                self._proc = _spawn(self._host, 'virsh --connect %s event' % self._uri,
+                                    all=True, loop=True, event='lifecycle')
+            thread = threading.Thread(target=_read_events,
+                                      args=(weakref.ref(self), self._proc))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        with self._cond:
+            if self._proc is not None:
+                self._proc.close()
+                self._proc = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # The interpreter may be shutting down.
+            pass
+
+    def _event(self, line):
+        match = _EVENT_RE.search(line)
+        if not match or match.group('event') not in _EVENT_STATES:
+            return
+        with self._cond:
+            self._seq += 1
+            self._states[match.group('domain')] = (
+                self._seq, _EVENT_STATES[match.group('event')])
+            self._cond.notify_all()
+
+    def _poll(self, list_states, since):
+        """Return the states of domains polled with **list_states** after the
+        time **since**. A single thread polls at a time and the result is
+        shared with the threads waiting for it. Called with the condition
+        held."""
+        import time
+        while self._poll_time < since:
+            if self._polling:
+                self._cond.wait()
+                continue
+            self._polling = True
+            poll_time = time.time()
+            self._cond.release()
+            try:
+                states = list_states()
+            finally:
+                self._cond.acquire()
+                self._polling = False
+                self._cond.notify_all()
+            self._poll_time, self._polled = poll_time, states
+        return self._polled
+
+    def wait(self, domains, states, list_states, timeout=None,
+             poll_interval=5):
+        """Wait for each domain of **domains** to be in one of **states**.
+        **list_states** is a function returning the current states of all
+        domains, it is used at the beginning, every **poll_interval** seconds
+        while the listener is running and every second if it is not (polls
+        are shared by the threads waiting at the same time). Return a
+        dictionnary with the state reached by each domain, domains that did
+        not reach a state before **timeout** seconds are not in it.
+        **KvmError** is raised if a domain does not exist."""
+        import time
+
+        self.start()
+        started = time.time()
+        deadline = started + timeout if timeout is not None else None
+        with self._cond:
+            start_seq = self._seq
+            # 'virsh event' may not be connected yet and miss transitions
+            # happening now, they are caught by polling states regularly.
+            polled = self._poll(list_states, started)
+            for domain in domains:
+                if domain not in polled:
+                    raise KvmError("domain '%s' not found" % domain)
+            current = {domain: polled[domain] for domain in domains}
+            reached = {domain: state for domain, state in current.items()
+                       if state in states}
+            poll_time = self._poll_time
+
+            while len(reached) < len(domains):
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    break
+                interval = poll_interval if self.alive() else 1
+                next_poll = poll_time + interval - time.time()
+                self._cond.wait(max(0, min(remaining, next_poll)
+                                       if remaining is not None else next_poll))
+                if time.time() >= poll_time + interval:
+                    polled = self._poll(list_states, poll_time + interval)
+                    poll_time = self._poll_time
+                    current.update((domain, polled.get(domain))
+                                   for domain in domains
+                                   if domain not in reached)
+
+                for domain in domains:
+                    seq, state = self._states.get(domain, (0, None))
+                    if seq > start_seq:
+                        current[domain] = state
+                    if current[domain] in states:
+                        reached.setdefault(domain, current[domain])
+        return reached
+
+
+#
+# Batches.
+#
+class _BatchCall(object):
+    """Command queued in a batch. Its result (or the exception raised when
+    parsing its output) is available once the batch is executed."""
+    def __init__(self, command, args, kwargs, parser, callback=None):
+        self.command = command
+        self.args = args
+        self.kwargs = kwargs
+        self._parser = parser
+        self._callback = callback
+        self._result = None
+        self._error = None
+        self._done = False
+
+    def _set(self, status, stdout, stderr):
+        self._done = True
+        try:
+            self._result = self._parser(status, stdout, stderr)
+        except Exception as err:
+            self._error = err
+        if self._callback is not None:
+            self._callback(self)
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Return the result of the command or raise its exception (a
+        **KvmError** exception for commands in error)."""
+        if not self._done:
+            raise KvmError('batch not executed')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise KvmError('batch not executed')
+        return self._error
+
+def _batch_parser(conf, typed):
+    """Return the function converting the output of a command to its result
+    according to its configuration in the mapping."""
+    def parse(status, stdout, stderr):
+        if not status:
+            raise KvmError(stderr)
+        lines = stdout.splitlines()
+        if conf['type'] == 'list' and typed:
+            return _list_records(lines)
+        return _parse(conf, lines)
+    return parse
+
+def _batch_raw(status, stdout, stderr):
+    return status, stdout, stderr
+
+def __add_batch_method(obj, group, method, conf):
+    cmd = conf.get('cmd', method)
+    ignore_opts = conf.get('disable', [])
+    tune_opts = ('config', 'live', 'current')
+
+    def batch_method(self, *args, **kwargs):
+        batch = self._batch
+        if conf['type'] == 'none' or (
+          conf['type'] == 'tune'
+          and kwargs
+          and not (len(kwargs) == 1 and any(opt in kwargs for opt in tune_opts))):
+            # Objects are given by a file when created or defined.
+            create = method.startswith(('create', 'define'))
+            obj = None if create or not args else args[0]
+            return batch._queue(cmd, args, kwargs, _batch_raw,
+                                lambda call: batch._invalidate(group, obj))
+        for opt in ignore_opts:
+            kwargs[opt] = False
+        return batch._queue(cmd, args, kwargs,
+                            _batch_parser(conf, batch._hypervisor._typed))
+    setattr(obj, method.replace('-', '_'), batch_method)
+
+# Classes of properties objects of batches.
+_BATCH_PROPERTIES = {}
+
+def _batch_properties():
+    if not _BATCH_PROPERTIES:
+        # Classes are built apart then added at once, so other threads never
+        # see a partial set of classes.
+        properties = {}
+        for property_name, property_methods in _MAPPING.items():
+            property_obj = type('_Batch%s' % str(property_name).capitalize(),
+                                (object,),
+                                dict(__init__=__batch_init))
+            for method_name, method_conf in property_methods.items():
+                __add_batch_method(property_obj, property_name, method_name,
+                                   method_conf)
+            properties[property_name] = property_obj
+        _BATCH_PROPERTIES.update(properties)
+    return _BATCH_PROPERTIES
+
+def __batch_init(self, batch):
+    self._batch = batch
+
+class _Batch(object):
+    """Commands executed in a single ``virsh`` run (see ``Hypervisor.batch``).
+    Methods of the properties (``batch.domain.state('guest1')``) and
+    ``virsh`` queue commands and return ``_BatchCall`` objects giving their
+    results once the batch is executed.
+
+    virsh writes errors on stderr after flushing stdout, so with both streams
+    merged, the output of each command is between markers echoed around it
+    and its errors are the ``error:`` lines in it. When the command line can't
+    be parsed by virsh, no command is executed and all commands are in error.
+    """
+    def __init__(self, hypervisor):
+        self._hypervisor = hypervisor
+        self._token = ''.join(random.choice(_CHOICES) for _ in range(0, 8))
+        self.calls = []
+        for property_name, property_obj in _batch_properties().items():
+            setattr(self, property_name, property_obj(self))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def _queue(self, command, args, kwargs, parser, callback=None):
+        call = _BatchCall(command, args, kwargs, parser, callback)
+        self.calls.append(call)
+        return call
+
+    def _invalidate(self, group, obj):
+        if self._hypervisor._cache is not None:
+            self._hypervisor._cache.invalidate(group, obj)
+
+    def virsh(self, command, *args, **kwargs):
+        """Queue the virsh **command**. Its result is a tuple with the status,
+        stdout and stderr of the command."""
+        return self._queue(command, args, kwargs, _batch_raw)
+
+    def execute(self):
+        """Execute queued commands and return them. The batch is then empty
+        and can be reused."""
+        calls, self.calls = self.calls, []
+        if not calls:
+            return calls
+
+        hypervisor = self._hypervisor
+        if hypervisor._session is not None:
+            # Commands are not costly in a persistent session.
+            for call in calls:
+                with hypervisor.set_controls(parse=False, ignore_opts=[]):
+                    call._set(*hypervisor.virsh(call.command, *call.args,
+                                                **call.kwargs))
+            return calls
+
+        try:
+            from shlex import quote
+        except ImportError:
+            from pipes import quote
+        markers = ['__kvm_batch_%s_%d__' % (self._token, index)
+                   for index in range(len(calls) + 1)]
+        script = ' ; '.join(
+            'echo %s ; %s %s' % (marker, call.command,
+                                 _format_args(call.args, call.kwargs))
+            for marker, call in zip(markers, calls))
+        script += ' ; echo %s' % markers[-1]
+        command = 'virsh --connect %s %s 2>&1' % (hypervisor._uri, quote(script))
+
+        with hypervisor.set_controls(decode='utf-8'):
+            status, stdout, stderr = _hooked(
+                hypervisor, 'virsh batch', tuple(call.command for call in calls),
+                {}, lambda: hypervisor.execute(command))
+
+        # Split output on markers.
+        outputs, lines, index = [], [], -1
+        for line in stdout.splitlines():
+            if index + 1 < len(markers) and line.endswith(markers[index + 1]):
+                if index >= 0:
+                    if line[:-len(markers[index + 1])]:
+                        lines.append(line[:-len(markers[index + 1])])
+                    outputs.append(lines)
+                lines, index = [], index + 1
+            else:
+                lines.append(line)
+        # Remaining lines are errors of virsh when no command has been
+        # executed or the partial output of the command during which virsh
+        # stopped.
+        unattributed = '\n'.join(lines) or stderr
+
+        for position, call in enumerate(calls):
+            if position >= len(outputs):
+                call._set(False, '', (unattributed or 'command not executed')
+                                     .rstrip('\n'))
+                continue
+            errors = [line for line in outputs[position]
+                      if line.startswith(('error:', 'warning:'))]
+            output = [line for line in outputs[position]
+                      if not line.startswith(('error:', 'warning:'))]
+            call._set(not any(line.startswith('error:') for line in errors),
+                      '\n'.join(output).rstrip('\n'), '\n'.join(errors))
+        return calls
+
+
 #
 ## Classes.
 #
-def Hypervisor(host, uri=None):
+class _Control(object):
+    """Descriptor of a control of hypervisors (``_parse``, ``_timeout``, ...).
+    Values set by ``set_controls`` are local to the current thread and only
+    last for the ``with`` block, other values are shared by all threads."""
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        controls = getattr(obj._local, 'controls', None)
+        if controls and self.name in controls:
+            return controls[self.name]
+        return obj._controls[self.name]
+
+    def __set__(self, obj, value):
+        obj._controls[self.name] = value
+
+# Classes of hypervisors indexed by class of host and backend.
+_CLASSES = {}
+_CLASSES_LOCK = threading.Lock()
+
+# Hosts on which the virsh command has been found.
+_VIRSH_HOSTS = set()
+
+def Hypervisor(host, uri=None, session=False, backend='virsh', cache=False,
+               cache_size=1024, check=True, typed=False):
     unix.isvalid(host)
 
-    try:
-        host.which('virsh')
-    except unix.UnixError:
-        raise KvmError("unable to find 'virsh' command, is this a KVM host?")
+    if backend not in _BACKENDS:
+        raise KvmError("invalid backend '%s'" % backend)
 
-    class Hypervisor(host.__class__):
+    if backend == 'libvirt':
+        try:
+            importlib.import_module('libvirt')
+        except ImportError:
+            raise KvmError("'libvirt' backend needs libvirt python bindings")
+    elif check and _hostname(host) not in _VIRSH_HOSTS:
+        try:
+            host.which('virsh')
+        except unix.UnixError:
+            raise KvmError("unable to find 'virsh' command, is this a KVM host?")
+        _VIRSH_HOSTS.add(_hostname(host))
+
+    key = (host.__class__, backend)
+    with _CLASSES_LOCK:
+        if key not in _CLASSES:
+            _CLASSES[key] = _hypervisor_class(host.__class__, backend)
+    return _CLASSES[key](host, uri, session, cache, cache_size, typed)
+
+def _hypervisor_class(host_class, backend):
+    """Build the class of hypervisors for hosts of type **host_class** using
+    **backend**."""
+    class Hypervisor(host_class):
         """This object represent an Hypervisor. **host** must be an object of
         type ``unix.Local`` or ``unix.Remote`` (or an object inheriting from
-        them).
+        them). If **session** is set, commands are sent to a persistent
+        ``virsh`` shell instead of starting a new process for each command
+        (or to a pool of **session** shells if it is an integer, for threads
+        using the hypervisor concurrently).
+        If **backend** is ``libvirt``, some methods use the libvirt python
+        bindings on a single connection instead of the ``virsh`` command (for
+        a ``unix.Remote`` host, **uri** must then be a remote URI like
+        ``qemu+ssh://hypervisor/system``). If **cache** is set, results of
+        read-mostly methods are cached (in an LRU cache of **cache_size**
+        entries) for the time to live (in seconds) defined in the mapping, or
+        in **cache** if it is a dictionnary (like ``{'domain.conf': 10}``).
+        Methods modifying an object invalidate its cached results. The
+        ``which virsh`` check is done once per host and can be disabled with
+        **check**. If **typed** is set, ``list_*`` methods (and methods of
+        the ``list`` type) return records (``Domain``, ``Pool``, ``Volume``,
+        ``Snapshot``) with sizes in bytes and states as enums, which can
+        also be read like dictionnaries.
         """
-        def __init__(self):
-            host.__class__.__init__(self)
-            self.__dict__.update(host.__dict__)
+        def __init__(self, host, uri, session, cache, cache_size, typed):
+            self._local = threading.local()
+            self._controls = {}
+            host_class.__init__(self)
+            self.__dict__.update((attr, value)
+                                 for attr, value in host.__dict__.items()
+                                 if not (attr.startswith('_')
+                                         and attr[1:] in unix._CONTROLS))
+            for control in unix._CONTROLS:
+                setattr(self, '_%s' % control,
+                        getattr(host, '_%s' % control, unix._CONTROLS[control]))
             for control, value in _CONTROLS.items():
                 setattr(self, '_%s' % control, value)
+            self._uri = uri or 'qemu:///session'
+            self._typed = typed
+            self._session = None
+            self._events = _Events(self, self._uri)
+            self._libvirt_conn = None
+            self._libvirt_lock = threading.Lock()
+            self._cache = None
+            if cache:
+                ttls = dict(_CACHE_TTLS)
+                ttls.update(('%s.%s' % (group, method), conf['ttl'])
+                            for group, methods in _MAPPING.items()
+                            for method, conf in methods.items()
+                            if 'ttl' in conf)
+                if isinstance(cache, dict):
+                    ttls.update(cache)
+                self._cache = _Cache(ttls, cache_size)
+            self._hooks = []
+            if session:
+                self.open_session(int(session))
+
+        def add_hook(self, hook):
+            """Add **hook** (an object of type ``Hook``) for the commands
+            executed on this hypervisor."""
+            self._hooks.append(hook)
+
+        def remove_hook(self, hook):
+            self._hooks.remove(hook)
+
+        @contextmanager
+        def set_controls(self, **controls):
+            """Set **controls** for the commands executed in the ``with``
+            block by the current thread, so a hypervisor (and its connection)
+            can be used by several threads at the same time."""
+            previous = getattr(self._local, 'controls', None)
+            self._local.controls = dict(previous or {}, **controls)
+            try:
+                yield None
+            finally:
+                self._local.controls = previous
+
+        def batch(self):
+            """Return a batch of commands executed in a single ``virsh`` run
+            (one process and one connection) when leaving the ``with``
+            block::
+
+                with hypervisor.batch() as batch:
+                    states = [batch.domain.state(domain) for domain in domains]
+                    batch.domain.setmem('guest1', 2097152, config=True)
+                print([state.result() for state in states])
+
+            Only methods of the mapping and ``virsh`` can be batched."""
+            return _Batch(self)
+
+        @property
+        def cache(self):
+            """Cache of the results of methods (``None`` if disabled)."""
+            return self._cache
+
+        def _libvirt(self):
+            """Return the libvirt connection, opening it on first use."""
+            import libvirt
+            with self._libvirt_lock:
+                if self._libvirt_conn is None or not self._libvirt_conn.isAlive():
+                    try:
+                        self._libvirt_conn = libvirt.open(self._uri)
+                    except libvirt.libvirtError as err:
+                        raise KvmError(str(err))
+                return self._libvirt_conn
+
+        def open_session(self, size=1, max_idle=300, timeout=300):
+            """Start a persistent ``virsh`` shell used by all next commands.
+            The shell is restarted if it dies or writes no output for
+            **timeout** seconds while executing a command. With **size**
+            greater than 1, up to **size** shells are started for executing
+            commands of several threads in parallel (see ``_SessionPool``);
+            shells idle for more than **max_idle** seconds are closed."""
+            if self._session is None:
+                self._session = _SessionPool(self, self._uri, size, max_idle,
+                                             timeout=timeout)
+            else:
+                self._session.size = size
+                self._session.max_idle = max_idle
+                self._session.timeout = timeout
+            if not self._session.alive():
+                self._session.start()
+
+        def close_session(self):
+            """Stop the persistent ``virsh`` shell. Next commands start a new
+            ``virsh`` process each."""
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+        def close_events(self):
+            """Stop the ``virsh event`` process used for waiting for states
+            of domains. It is started again when needed."""
+            self._events.close()
 
         def virsh(self, command, *args, **kwargs):
             """Wrap the execution of the virsh command. It set a control for
@@ -254,9 +1823,14 @@ def Hypervisor(host, uri=None):
                 for opt in self._ignore_opts:
                     kwargs.update({opt: False})
 
-            virsh_cmd = 'virsh --connect %s' % (uri or 'qemu:///session')
+            virsh_cmd = 'virsh --connect %s' % self._uri
             with self.set_controls(options_place='after', decode='utf-8'):
-                status, stdout, stderr = self.execute(virsh_cmd, command, *args, **kwargs)
+                if self._session is not None:
+                    execute = lambda: self._session.execute(command, *args, **kwargs)
+                else:
+                    execute = lambda: self.execute(virsh_cmd, command, *args, **kwargs)
+                status, stdout, stderr = _hooked(self, 'virsh %s' % command,
+                                                 args, kwargs, execute)
                 # Clean stdout and stderr.
                 if stdout:
                     stdout = stdout.rstrip('\n')
@@ -268,8 +1842,9 @@ def Hypervisor(host, uri=None):
                 elif not status:
                     raise KvmError(stderr)
                 else:
+                    # Commands like 'domstats' print nothing without domains.
                     stdout = stdout.splitlines()
-                    return stdout[:-1] if not stdout[-1] else stdout
+                    return stdout[:-1] if stdout and not stdout[-1] else stdout
 
         def list_domains(self, **kwargs):
             """List domains. **kwargs** can contains any option supported by the
@@ -296,140 +1871,162 @@ def Hypervisor(host, uri=None):
                 * *without_managed_save*: list domains not having a managed
                                           save image
             """
-            # Remove incompatible options between virsh versions.
-            kwargs.pop('name', None)
-            kwargs.pop('uuid', None)
-
-            # Get states argument (which is not an option of the virsh command).
-            states = kwargs.pop('states', [])
-            if states:
-                kwargs['all'] = True
-
-            # Add virsh options for kwargs.
-            virsh_opts = {arg: value for arg, value in kwargs.items() if value}
-
-            # Get domains (filtered on state).
-            domains = {}
+            virsh_opts = _domains_options(kwargs)
             with self.set_controls(parse=True):
-                stdout = self.virsh('list', **virsh_opts)
-
-                for line in stdout[2:]:
-                    line = line.split()
-                    (domid, name, state), params = line[:3], line[3:]
-                    # Manage state in two words.
-                    if state == 'shut':
-                        state += ' %s' % params.pop(0)
-                    domain = {'id': int(domid) if domid != '-' else -1,
-                              'state': state}
-                    if 'title' in kwargs:
-                        domain['title'] = ' '.join(params) if params else ''
-                    domains[name] = domain
-
-            return domains
-
+                lines = self.virsh('list', **virsh_opts)
+            return (_domain_records if self._typed else _domains)(
+                lines, 'title' in kwargs)
+
+        def _iter_virsh(self, command, parse_row, *args, **kwargs):
+            """Execute the virsh **command** in a new process and yield its
+            output lines (without the two header lines) parsed by
+            **parse_row** as soon as they are read. **KvmError** is raised at
+            the end if the command failed."""
+            hooks, call = _pre_hooks(self, 'virsh %s' % command, args, kwargs)
+            with self.set_controls(options_place='after', decode='utf-8'):
+                proc = _spawn(self, 'virsh --connect %s %s' % (self._uri, command),
+                              *args, **kwargs)
+            status, stdout_size, stderr = False, 0, ''
+            try:
+                for index, line in enumerate(iter(proc.readline, '')):
+                    stdout_size += len(line)
+                    if index >= 2 and line.strip():
+                        yield parse_row(line)
+                status = proc.wait() == 0
+                stderr = proc.read_stderr().rstrip('\n')
+            finally:
+                proc.close()
+                if hooks:
+                    _post_hooks(hooks, call, status, stdout_size, len(stderr))
+            if not status:
+                raise KvmError(stderr)
+
+        def iter_domains(self, **kwargs):
+            """Generator of tuples with the name of a domain and its
+            informations (see ``list_domains`` for **kwargs** and
+            informations). Domains are yielded as the output of ``virsh`` is
+            read so memory does not depend on the number of domains."""
+            title = 'title' in kwargs
+            row = _domain_record_row if self._typed else _domain_row
+            return self._iter_virsh('list', lambda line: row(line, title),
+                                    **_domains_options(kwargs))
+
+        def iter_volumes(self, pool, **kwargs):
+            """Generator of tuples with the name of a volume of **pool** and
+            its informations (see ``list_volumes``). Volumes are yielded as
+            the output of ``virsh`` is read so memory does not depend on the
+            number of volumes."""
+            row = _volume_record_row if self._typed else _volume_row
+            return self._iter_virsh('vol-list', row, pool, **kwargs)
+
+        @_cached('list_networks')
         def list_networks(self, **kwargs):
             with self.set_controls(parse=True):
-                stdout = self.virsh('net-list', **kwargs)
-                networks = {}
-                for line in stdout[2:]:
-                    line = line.split()
-                    name, state, autostart = line[:3]
-                    net = dict(state=state, autostart=_convert(autostart))
-                    if len(line) == 4:
-                        net.update(persistent=_convert(line[3]))
-                    networks.setdefault(name, net)
-            return networks
+                return _networks(self.virsh('net-list', **kwargs))
 
+        @_cached('list_interfaces')
         def list_interfaces(self, **kwargs):
             with self.set_controls(parse=True):
-                stdout = self.virsh('iface-list', **kwargs)
-                return {name: {'state': state, 'mac': mac}
-                        for line in self.virsh('iface-list', **kwargs)[2:]
-                        for name, state, mac in [line.split()]}
+                return _interfaces(self.virsh('iface-list', **kwargs))
 
+        @_cached('list_pools')
         def list_pools(self, **kwargs):
             with self.set_controls(parse=True):
-                stdout = self.virsh('pool-list', **kwargs)
-                pools = {}
-                for line in stdout[2:]:
-                    line = line.split()
-                    name, state, autostart = line[:3]
-                    pool = dict(state=state, autostart=_convert(autostart))
-                    if len(line) > 3:
-                        pool.update(persistent=_convert(line[3]),
-                                    capacity=' '.join(line[4:6]),
-                                    allocation=' '.join(line[6:8]),
-                                    available=' '.join(line[8:10]))
-                    pools.setdefault(line[0], pool)
-                return pools
+                lines = self.virsh('pool-list', **kwargs)
+            return (_pool_records if self._typed else _pools)(lines)
 
+        @_cached('list_volumes')
         def list_volumes(self, pool, **kwargs):
             with self.set_controls(parse=True):
-                stdout = self.virsh('vol-list', pool, **kwargs)
-                volumes = {}
-                for line in stdout[2:]:
-                    line = line.split()
-                    name, path = line[:2]
-                    volume = dict(path=path)
-                    if len(line) > 2:
-                        volume.update(type=line[2],
-                                      capacity=' '.join(line[3:5]),
-                                      allocation=' '.join(line[5:7]))
-                    volumes.setdefault(name, volume)
-                return volumes
+                lines = self.virsh('vol-list', pool, **kwargs)
+            return (_volume_records if self._typed else _volumes)(lines)
 
+        @_cached('list_secrets')
         def list_secrets(self, **kwargs):
             with self.set_controls(parse=True):
-                stdout = self.virsh('secret-list', **kwargs)
-                secrets = {}
-                for line in stdout[2:]:
-                    line = line.split()
-                    uuid, usage = line[0], line[1:]
-                    secrets.setdefault(uuid, ' '.join(usage))
-                return secrets
+                return _secrets(self.virsh('secret-list', **kwargs))
+
+        def domain_stats(self, domains=None, groups=_DOMSTATS_GROUPS, **kwargs):
+            """Get statistics of all domains (or only of **domains**) with a
+            single ``virsh domstats`` command. **groups** are the statistics
+            groups to get (*state*, *cpu_total*, *balloon*, *vcpu*,
+            *interface* and *block*). **kwargs** can contains any other option
+            of the command (like *list_active* or *backing*).
+
+            The result is indexed by domain, then by group (*state*, *cpu*,
+            *balloon*, *vcpu*, *net* and *block*) and, for groups containing
+            devices, by device (name of interfaces and disks, number of
+            vcpus). Numeric values are converted to integers::
+
+                {'guest1': {'state': {'state': 1, 'reason': 1},
+                            'cpu': {'time': 1846420000, ...},
+                            'block': {'vda': {'rd_reqs': 7325, ...}}}}
+            """
+            for group in groups:
+                kwargs[group] = True
+            with self.set_controls(parse=True):
+                stdout = self.virsh('domstats', *(domains or []), **kwargs)
+            return _domstats(_domstats_records(stdout))
 
         def list_snapshots(self, domain, **kwargs):
             kwargs.pop('tree', None)
             kwargs.pop('name', None)
             with self.set_controls(parse=True):
-                stdout = self.virsh('snapshot-list', domain, **kwargs)
-                snapshots = {}
-                for line in stdout[2:]:
-                    line = line.split()
-                    creation_date = datetime.strptime(' '.join(line[1:4]),
-                                                      '%Y-%m-%d %H:%M:%S %z')
-                    state = line[4]
-                    if state == 'shut':
-                        state += line[5]
-                        parent = line[6] if 'parent' in kwargs else None
-                    else:
-                        parent = line[5] if 'parent' in kwargs else None
-                    snapshot = {'creation_date': creation_date, 'state': state}
-                    if parent and parent != 'null':
-                        snapshot.update(parent=parent)
-                    snapshots.setdefault(line[0], snapshot)
-                return snapshots
+                lines = self.virsh('snapshot-list', domain, **kwargs)
+            return (_snapshot_records if self._typed else _snapshots)(
+                lines, 'parent' in kwargs)
 
         @property
         def image(self):
             return _Image(weakref.ref(self)())
 
+    for property_name, property_obj in _properties(backend).items():
+        setattr(Hypervisor, property_name, property(property_obj))
+    for control in unix._CONTROLS:
+        setattr(Hypervisor, '_%s' % control, _Control(control))
+
+    if backend == 'libvirt':
+        Hypervisor.list_domains = __libvirt_list_domains
+        Hypervisor.domain_stats = __libvirt_domain_stats
+
+    return Hypervisor
+
+# Classes of properties objects indexed by backend.
+_PROPERTIES = {}
+
+def _properties(backend):
+    """Return the classes of properties objects (``domain``, ``pool``, ...)
+    for **backend**, building them on first use."""
+    if backend in _PROPERTIES:
+        return _PROPERTIES[backend]
+
+    functions = [name for name in dir(_SELF) if name.startswith('__')]
+    properties = {}
     for property_name, property_methods in _MAPPING.items():
         property_obj = type('_%s' % str(property_name).capitalize(),
                             (object,),
                             dict(__init__=__init))
 
         for method_name, method_conf in property_methods.items():
-            __add_method(property_obj, method_name, method_conf)
-        #    getattr(Hypervisor, method['name']).__doc__ = '\n'.join(method['doc'])
+            __add_method(property_obj, property_name, method_name, method_conf)
 
-        for method_name in dir(_SELF):
+        for method_name in functions:
             if method_name.startswith('__%s' % property_name):
                 method = method_name.replace('__%s_' % property_name, '')
-                setattr(property_obj, method, getattr(_SELF, method_name))
-        setattr(Hypervisor, property_name, property(property_obj))
+            elif (backend == 'libvirt'
+                  and method_name.startswith('__libvirt_%s_' % property_name)):
+                method = method_name.replace('__libvirt_%s_' % property_name, '')
+            else:
+                continue
+            func = getattr(_SELF, method_name)
+            name = '%s.%s' % (property_name, method)
+            if method in property_methods or name in _CACHE_TTLS:
+                func = _cached(name)(func)
+            setattr(property_obj, method, func)
+        properties[property_name] = property_obj
 
-    return Hypervisor()
+    _PROPERTIES[backend] = properties
+    return properties
 
 
 def __init(self, host):
@@ -485,23 +2082,35 @@ def __domain_cpustats(self, domain, **kwargs):
                 stats[cur_cpu][param] = '%s %s' % (value, unit)
         return stats
 
-def __domain_stop(self, domain, timeout=30, force=False):
-    import signal, time
-
-    def timeout_handler(signum, frame):
-        raise TimeoutException()
+def __domain_wait_for_states(self, domains, states, timeout=None):
+    """Wait for each domain of **domains** to be in one of **states** (a state
+    or a list of states) using lifecycle events. Return a dictionnary with the
+    state reached by each domain, domains that did not reach one of the
+    states after **timeout** seconds are not in it. This method can be used
+    from any thread."""
+    states = [states] if isinstance(states, str) else list(states)
+    list_states = lambda: {domain: str(infos['state']) for domain, infos
+                           in self._host.list_domains(all=True).items()}
+    return self._host._events.wait(list(domains), states, list_states, timeout)
+
+def __domain_wait_for_state(self, domain, states, timeout=None):
+    """Wait for **domain** to be in one of **states** (a state or a list of
+    states) and return the state. **TimeoutException** is raised when no
+    state is reached after **timeout** seconds."""
+    reached = self.wait_for_states([domain], states, timeout)
+    if domain not in reached:
+        raise TimeoutException("domain '%s' not in state %s after %ss"
+                               % (domain, states, timeout))
+    return reached[domain]
 
+def __domain_stop(self, domain, timeout=30, force=False):
     # Check guest exists.
     if domain not in self._host.list_domains(all=True):
         return [False, '', 'Domain not found']
 
     self.shutdown(domain)
-    old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(timeout)
-
     try:
-        while self.state(domain) != SHUTOFF:
-            time.sleep(1)
+        self.wait_for_state(domain, SHUTOFF, timeout)
     except TimeoutException:
         if force:
             status, stdout, stderr = self.destroy(domain)
@@ -510,11 +2119,341 @@ def __domain_stop(self, domain, timeout=30, force=False):
             return (status, stdout, stderr)
         else:
             return (False, '', 'VM not stopped after %ss' % timeout)
-    finally:
-        signal.signal(signal.SIGALRM, old_handler)
-        signal.alarm(0)
     return [True, '', '']
 
+def _bulk(domains, priority, max_parallel, func):
+    """Execute **func** for each domain of **domains** in threads, with at
+    most **max_parallel** domains processed at the same time (all by
+    default). Domains are processed by increasing **priority** (a dictionnary
+    or a function giving the priority of a domain, 0 by default), domains of a
+    priority being processed once all domains of lower priorities are done.
+    **func** fills the report of a domain (a dictionnary with the *status*,
+    the *state* reached, the *actions* done and the *error*) which is also
+    given the *duration* of the operation. Return reports indexed by domain
+    (in processing order)."""
+    import time
+    from concurrent import futures
+
+    if priority is None:
+        get_priority = lambda domain: 0
+    elif isinstance(priority, dict):
+        get_priority = lambda domain: priority.get(domain, 0)
+    else:
+        get_priority = priority
+    waves = OrderedDict()
+    for domain in sorted(domains, key=get_priority):
+        waves.setdefault(get_priority(domain), []).append(domain)
+
+    def run(domain):
+        start = time.time()
+        report = {'status': True, 'state': None, 'actions': [], 'error': None}
+        try:
+            func(domain, report)
+        except Exception as err:
+            report.update(status=False, error=str(err))
+        report['duration'] = time.time() - start
+        return report
+
+    reports = OrderedDict()
+    if not waves:
+        return reports
+    executor = futures.ThreadPoolExecutor(
+        max_workers=max_parallel or max(len(wave) for wave in waves.values()))
+    try:
+        for wave in waves.values():
+            reports.update(zip(wave, executor.map(run, wave)))
+    finally:
+        executor.shutdown(wait=True)
+    return reports
+
+def _bulk_stop(self, states, domain, report, timeout, force):
+    """Stop **domain** (which was in the state given by **states**) for
+    ``stop_many`` and ``reboot_many``. Return whether it is stopped."""
+    if domain not in states:
+        report.update(status=False, error='Domain not found')
+        return False
+    if states[domain] == SHUTOFF:
+        report['state'] = SHUTOFF
+        return True
+
+    report['actions'].append('shutdown')
+    status, _, stderr = self.shutdown(domain)
+    if not status:
+        report.update(status=False, error=stderr)
+        return False
+    try:
+        report['state'] = self.wait_for_state(domain, SHUTOFF, timeout)
+        return True
+    except TimeoutException:
+        if not force:
+            report.update(status=False, error='VM not stopped after %ss' % timeout)
+            return False
+
+    report['actions'].append('destroy')
+    status, _, stderr = self.destroy(domain)
+    if not status:
+        report.update(status=False, error=stderr)
+        return False
+    report['state'] = SHUTOFF
+    return True
+
+def _bulk_start(self, states, domain, report):
+    """Start **domain** for ``start_many`` and ``reboot_many``."""
+    if domain not in states:
+        report.update(status=False, error='Domain not found')
+        return
+    if states[domain] == RUNNING:
+        report['state'] = RUNNING
+        return
+
+    report['actions'].append('start')
+    status, _, stderr = self.start(domain)
+    if not status:
+        report.update(status=False, error=stderr)
+        return
+    report['state'] = RUNNING
+
+def __domain_stop_many(self, domains, timeout=30, force=False,
+                       max_parallel=None, priority=None):
+    """Stop **domains** in parallel: shutdowns are sent to at most
+    **max_parallel** domains at the same time (all by default) and they are
+    waited for together. A domain still running after **timeout** seconds is
+    destroyed if **force** is set. Domains are stopped by increasing
+    **priority** (a dictionnary or a function giving the priority of a
+    domain, 0 by default), all domains of a priority being stopped before the
+    next priority. Return a report for each domain::
+
+        {'guest1': {'status': True, 'state': 'shut off',
+                    'actions': ['shutdown', 'destroy'], 'error': None,
+                    'duration': 30.1}}
+    """
+    states = {domain: infos['state']
+              for domain, infos in self._host.list_domains(all=True).items()}
+    return _bulk(domains, priority, max_parallel,
+                 lambda domain, report: _bulk_stop(self, states, domain,
+                                                   report, timeout, force))
+
+def __domain_start_many(self, domains, max_parallel=None, priority=None):
+    """Start **domains** in parallel (at most **max_parallel** at the same
+    time) by increasing **priority** (see ``stop_many``). Return a report for
+    each domain."""
+    states = {domain: infos['state']
+              for domain, infos in self._host.list_domains(all=True).items()}
+    return _bulk(domains, priority, max_parallel,
+                 lambda domain, report: _bulk_start(self, states, domain, report))
+
+def __domain_reboot_many(self, domains, timeout=30, force=False,
+                         max_parallel=None, priority=None):
+    """Reboot **domains** in parallel (at most **max_parallel** at the same
+    time) by increasing **priority** (see ``stop_many``). Each domain is
+    stopped (and destroyed after **timeout** seconds if **force** is set) then
+    started again, so a domain which can not be stopped is not restarted.
+    Shut off domains are only started. Return a report for each domain."""
+    states = {domain: infos['state']
+              for domain, infos in self._host.list_domains(all=True).items()}
+
+    def reboot(domain, report):
+        if _bulk_stop(self, states, domain, report, timeout, force):
+            _bulk_start(self, {domain: SHUTOFF}, domain, report)
+    return _bulk(domains, priority, max_parallel, reboot)
+
+def _clone_conf(conf, name, overlays, allocator=None):
+    """Return the configuration of the clone **name** of the domain **conf**
+    with disks (indexes in ``conf['devices']['disk']``) replaced by
+    **overlays** (a dictionnary with the path of each overlay). Identifiers
+    are got from **allocator** if set."""
+    import copy
+    clone = copy.deepcopy(conf)
+    clone.pop('@id', None)
+    clone['name'] = name
+    clone['uuid'] = allocator.uuid() if allocator is not None else gen_uuid()
+    if isinstance(clone.get('os'), dict):
+        # The clone gets its own UEFI variables from the template of the loader.
+        clone['os'].pop('nvram', None)
+    if (isinstance(clone.get('seclabel'), dict)
+      and clone['seclabel'].get('@type') == 'dynamic'):
+        clone['seclabel'].pop('label', None)
+        clone['seclabel'].pop('imagelabel', None)
+
+    devices = clone['devices']
+    for interface in devices.get('interface', []):
+        interface['mac'] = {'@address': allocator.mac() if allocator is not None
+                                                    else gen_mac()}
+        interface.pop('target', None)
+        interface.pop('alias', None)
+    for index, path in overlays.items():
+        disk = devices['disk'][index]
+        disk['@type'] = 'file'
+        disk['source'] = {'@file': path}
+        driver = disk.get('driver')
+        disk['driver'] = dict(driver if isinstance(driver, dict)
+                              else {'@name': 'qemu'}, **{'@type': 'qcow2'})
+        disk.pop('backingStore', None)
+        disk.pop('alias', None)
+    return clone
+
+def __domain_clone_many(self, template, names, directory=None, start=False,
+                        max_parallel=None, chunk_size=100, allocator=None):
+    """Create the clones **names** of the shut off domain **template**. Disks
+    of clones are qcow2 overlays backed by the disks of the template
+    (``<name>-<target>.qcow2`` files in **directory**, the directory of each
+    disk of the template by default), so a clone costs a few KiB of I/O
+    whatever the size of its disks. Only file, block and volume disks get
+    overlays: shareable, network and directory disks, cdroms and floppies
+    are shared with the template. Names, UUIDs and MAC addresses are regenerated
+    (by the ``IdAllocator`` **allocator** if set, for identifiers unique in a
+    fleet) and clones are defined in a single ``virsh`` run. Overlays are created by
+    commands of **chunk_size** clones. If **start** is set, clones are then
+    started in parallel (at most **max_parallel** at the same time). Return a
+    report for each clone::
+
+        {'ci1': {'status': True, 'state': 'running',
+                 'actions': ['overlay', 'define', 'start'], 'error': None,
+                 'uuid': 'e486003f-9f11-f7df-5ed4-cceddbf087ab',
+                 'macs': ['54:52:00:a3:0c:5e'],
+                 'disks': ['/vm/disk/ci1-vda.qcow2']}}
+
+    The template must not be started nor its disks modified while clones use
+    them.
+    """
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+
+    if self.state(template) != SHUTOFF:
+        raise KvmError("template '%s' must be shut off" % template)
+    conf = self.conf(template, inactive=True)
+
+    # Disks of the template: index in devices, target, path and format.
+    disks = []
+    for index, disk in enumerate(conf['devices'].get('disk', [])):
+        if (disk.get('@device', 'disk') != 'disk' or 'shareable' in disk
+          or disk.get('@type', 'file') not in ('file', 'block', 'volume')
+          or not isinstance(disk.get('source'), dict)):
+            continue
+        source = disk['source']
+        if disk.get('@type') == 'volume':
+            path = self._host.volume.path(source['@volume'],
+                                          pool=source['@pool'])
+        else:
+            path = source.get('@file') or source.get('@dev')
+        if not path:
+            continue
+        driver = disk.get('driver')
+        disks.append((index, disk['target']['@dev'], path,
+                      driver.get('@type', 'raw') if isinstance(driver, dict)
+                                                 else 'raw'))
+
+    existing = self._host.list_domains(all=True)
+    reports = OrderedDict()
+    overlays = {}
+    for name in names:
+        reports[name] = {'status': True, 'state': None, 'actions': [],
+                         'error': None, 'uuid': None, 'macs': [], 'disks': []}
+        if name in existing:
+            reports[name].update(status=False, error='Domain already exists')
+            continue
+        overlays[name] = OrderedDict(
+            (index, os.path.join(directory or os.path.dirname(path),
+                                 '%s-%s.qcow2' % (name, target)))
+            for index, target, path, _ in disks)
+
+    # Create overlays, the output of each clone is followed by a marker with
+    # the status of its commands. When an overlay of a clone can't be
+    # created, the overlays already created for it are removed.
+    marker = '__kvm_clone_%s__' % ''.join(random.choice(_CHOICES)
+                                          for _ in range(0, 8))
+    pending = list(overlays)
+    for chunk in range(0, len(pending), chunk_size):
+        script = []
+        for name in pending[chunk:chunk + chunk_size]:
+            commands = [
+                'if [ -e %(dst)s ]; then echo %(dst)s: file exists >&2; false; '
+                'else qemu-img create -q -f qcow2 -F %(format)s -b %(src)s '
+                '%(dst)s && c%(index)d=1; fi'
+                % {'dst': quote(overlays[name][index]), 'src': quote(path),
+                   'format': quote(fmt), 'index': index}
+                for index, _, path, fmt in disks]
+            cleanup = ''.join('[ -z "$c%d" ] || rm -f %s; '
+                              % (index, quote(overlays[name][index]))
+                              for index, _, _, _ in disks)
+            script.append('%s{ %s; } 2>&1 >/dev/null; s=$?; '
+                          '[ $s -eq 0 ] || { %s:; }; echo %s $s %s'
+                          % (''.join('c%d=; ' % index for index, _, _, _ in disks),
+                             ' && '.join(commands or [':']), cleanup,
+                             marker, quote(name)))
+        command = 'sh -c %s' % quote('\n'.join(script))
+        with self._host.set_controls(decode='utf-8'):
+            status, stdout, stderr = _hooked(
+                self._host, 'qemu-img create', tuple(pending[chunk:chunk + chunk_size]),
+                {}, lambda: self._host.execute(command))
+
+        errors, done = [], set()
+        for line in stdout.splitlines():
+            if not line.startswith(marker):
+                errors.append(line)
+                continue
+            _, returncode, name = line.split(' ', 2)
+            done.add(name)
+            if returncode == '0':
+                reports[name]['actions'].append('overlay')
+                reports[name]['disks'] = list(overlays[name].values())
+            else:
+                reports[name].update(status=False,
+                                     error='\n'.join(errors) or 'overlay failed')
+            errors = []
+        for name in pending[chunk:chunk + chunk_size]:
+            if name not in done:
+                reports[name].update(status=False,
+                                     error=stderr or 'overlay not created')
+
+    # Define clones from XML files written beside their first disk.
+    calls, paths = OrderedDict(), []
+    with self._host.batch() as batch:
+        for name, report in reports.items():
+            if not report['status']:
+                continue
+            clone = _clone_conf(conf, name, overlays[name], allocator)
+            report['uuid'] = clone['uuid']
+            report['macs'] = [interface['mac']['@address']
+                              for interface in clone['devices'].get('interface', [])]
+            path = os.path.join(
+                directory or (os.path.dirname(report['disks'][0])
+                              if report['disks'] else '/tmp'),
+                '%s.xml' % name)
+            try:
+                with self._host.open(path, 'w') as fhandler:
+                    fhandler.write(to_xml('domain', clone).encode())
+            except (IOError, OSError) as err:
+                report.update(status=False, error=str(err))
+                continue
+            paths.append(path)
+            calls[name] = batch.domain.define(path)
+    for name, call in calls.items():
+        status, _, stderr = call.result()
+        if status:
+            reports[name]['actions'].append('define')
+            reports[name]['state'] = SHUTOFF
+        else:
+            reports[name].update(status=False, error=stderr)
+    # Overlays of clones which have not been defined are removed with XML
+    # files.
+    for report in reports.values():
+        if not report['status'] and report['disks']:
+            paths.extend(report['disks'])
+            report['disks'] = []
+    if paths:
+        self._host.execute('rm', '-f', *paths)
+
+    if start:
+        defined = [name for name, report in reports.items() if report['status']]
+        for name, started in self.start_many(defined, max_parallel).items():
+            reports[name]['actions'].extend(started['actions'])
+            reports[name].update(status=started['status'],
+                                 state=started['state'], error=started['error'])
+    return reports
+
 def __snapshot_current(self, domain, **kwargs):
     with self._host.set_controls(parse=True):
         result = self._host.virsh('snapshot-current', domain, **kwargs)
@@ -523,53 +2462,1150 @@ def __snapshot_current(self, domain, **kwargs):
                 else from_xml(etree.fromstring('\n'.join(result)), [])['domainsnapshot'])
 
 
+#
+# Libvirt backend.
+#
+_BACKENDS = ('virsh', 'libvirt')
+
+# Domain states as printed by virsh, indexed by libvirt state values.
+_LIBVIRT_STATES = ('no state', RUNNING, IDLE, PAUSED, 'in shutdown', SHUTOFF,
+                   CRASHED, SUSPENDED)
+
+# Options of 'virsh list' with their libvirt flags.
+_LIBVIRT_LIST_FLAGS = {'inactive': 'VIR_CONNECT_LIST_DOMAINS_INACTIVE',
+                       'persistent': 'VIR_CONNECT_LIST_DOMAINS_PERSISTENT',
+                       'transient': 'VIR_CONNECT_LIST_DOMAINS_TRANSIENT',
+                       'autostart': 'VIR_CONNECT_LIST_DOMAINS_AUTOSTART',
+                       'no_autostart': 'VIR_CONNECT_LIST_DOMAINS_NO_AUTOSTART',
+                       'with_snapshot': 'VIR_CONNECT_LIST_DOMAINS_HAS_SNAPSHOT',
+                       'without_snapshot': 'VIR_CONNECT_LIST_DOMAINS_NO_SNAPSHOT',
+                       'with_managed_save': 'VIR_CONNECT_LIST_DOMAINS_MANAGEDSAVE',
+                       'without_managed_save': 'VIR_CONNECT_LIST_DOMAINS_NO_MANAGEDSAVE'}
+
+# Options of 'virsh dumpxml' with their libvirt flags.
+_LIBVIRT_XML_FLAGS = {'inactive': 'VIR_DOMAIN_XML_INACTIVE',
+                      'security_info': 'VIR_DOMAIN_XML_SECURE',
+                      'update_cpu': 'VIR_DOMAIN_XML_UPDATE_CPU',
+                      'migratable': 'VIR_DOMAIN_XML_MIGRATABLE'}
+
+# Groups of 'virsh domstats' with their libvirt flags.
+_LIBVIRT_DOMSTATS_FLAGS = {'state': 'VIR_DOMAIN_STATS_STATE',
+                           'cpu_total': 'VIR_DOMAIN_STATS_CPU_TOTAL',
+                           'balloon': 'VIR_DOMAIN_STATS_BALLOON',
+                           'vcpu': 'VIR_DOMAIN_STATS_VCPU',
+                           'interface': 'VIR_DOMAIN_STATS_INTERFACE',
+                           'block': 'VIR_DOMAIN_STATS_BLOCK'}
+
+# Keys of 'virsh domblkstat' for libvirt block stats.
+_LIBVIRT_BLKSTAT_KEYS = {'rd_operations': 'rd_req', 'wr_operations': 'wr_req'}
+
+# Keys of 'virsh domifstat', in the order of libvirt interface stats.
+_LIBVIRT_IFSTAT_KEYS = ('rx_bytes', 'rx_packets', 'rx_errs', 'rx_drop',
+                        'tx_bytes', 'tx_packets', 'tx_errs', 'tx_drop')
+
+def _libvirt_flags(flags, kwargs):
+    import libvirt
+    value = 0
+    for opt, flag in flags.items():
+        if kwargs.get(opt):
+            value |= getattr(libvirt, flag, 0)
+    return value
+
+def _libvirt_call(host, method, *args):
+    """Call **method** on the libvirt connection of **host**. **method** can
+    be a callable taking the connection as first argument. libvirt errors are
+    raised as **KvmError**."""
+    import libvirt
+    conn = host._libvirt()
+    try:
+        if callable(method):
+            return method(conn, *args)
+        return getattr(conn, method)(*args)
+    except libvirt.libvirtError as err:
+        raise KvmError(str(err))
+
+def _libvirt_domain(conn, domain):
+    """Return the domain object for **domain** which can be a name, an id or
+    an uuid (like virsh does)."""
+    import libvirt
+    domain = str(domain)
+    if domain.isdigit():
+        try:
+            return conn.lookupByID(int(domain))
+        except libvirt.libvirtError:
+            pass
+    try:
+        return conn.lookupByName(domain)
+    except libvirt.libvirtError:
+        if len(domain) == 36:
+            return conn.lookupByUUIDString(domain)
+        raise
+
+def __libvirt_list_domains(self, **kwargs):
+    """List domains using libvirt python bindings. Arguments and result are
+    the same than the ``virsh`` backend."""
+    import libvirt
+    flags = _libvirt_flags(_LIBVIRT_LIST_FLAGS, kwargs)
+    if kwargs.pop('states', []):
+        kwargs['all'] = True
+    if not kwargs.get('all') and not kwargs.get('inactive'):
+        flags |= libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE
+
+    def list_domains(conn):
+        domains = {}
+        for dom in conn.listAllDomains(flags):
+            domain = {'id': dom.ID(),
+                      'state': _LIBVIRT_STATES[dom.state()[0]]}
+            if 'title' in kwargs:
+                try:
+                    domain['title'] = dom.metadata(
+                        libvirt.VIR_DOMAIN_METADATA_TITLE, None)
+                except libvirt.libvirtError:
+                    domain['title'] = ''
+            if self._typed:
+                domain = Domain(dom.name(), domain['id'],
+                                _state(DomainState, domain['state']),
+                                domain.get('title'))
+            domains[dom.name()] = domain
+        return domains
+    return _libvirt_call(self, list_domains)
+
+def __libvirt_domain_stats(self, domains=None, groups=_DOMSTATS_GROUPS, **kwargs):
+    """Get statistics of domains using libvirt python bindings. Arguments and
+    result are the same than the ``virsh`` backend."""
+    stats = _libvirt_flags(_LIBVIRT_DOMSTATS_FLAGS, {group: True for group in groups})
+
+    def domain_stats(conn):
+        if domains:
+            records = conn.domainListGetStats(
+                [_libvirt_domain(conn, domain) for domain in domains], stats)
+        else:
+            records = conn.getAllDomainStats(stats)
+        return [(dom.name(), {key: str(value) for key, value in flat_stats.items()})
+                for dom, flat_stats in records]
+    return _domstats(_libvirt_call(self, domain_stats))
+
+def __libvirt_domain_state(self, domain, **kwargs):
+    state = lambda conn: _libvirt_domain(conn, domain).state()[0]
+    return _LIBVIRT_STATES[_libvirt_call(self._host, state)]
+
+def __libvirt_domain_info(self, domain):
+    def info(conn):
+        dom = _libvirt_domain(conn, domain)
+        state, max_memory, used_memory, cpus, cpu_time = dom.info()
+        result = {'id': dom.ID() if dom.ID() != -1 else '-',
+                  'name': dom.name(),
+                  'uuid': dom.UUIDString(),
+                  'os_type': dom.OSType(),
+                  'state': _LIBVIRT_STATES[state],
+                  'cpus': cpus,
+                  'max_memory': '%d KiB' % max_memory,
+                  'used_memory': '%d KiB' % used_memory,
+                  'persistent': bool(dom.isPersistent()),
+                  'autostart': 'enable' if dom.autostart() else 'disable',
+                  'managed_save': bool(dom.hasManagedSaveImage())}
+        if dom.isActive():
+            result['cpu_time'] = '%.1fs' % (cpu_time / 1e9)
+        model, doi = conn.getSecurityModel()
+        result.update(security_model=model or 'none',
+                      security_doi=_convert(doi or '0'))
+        if model:
+            label, enforcing = dom.securityLabel()
+            if label:
+                result['security_label'] = '%s (%s)' % (
+                    label, 'enforcing' if enforcing else 'permissive')
+        return result
+    return _libvirt_call(self._host, info)
+
+def __libvirt_domain_conf(self, domain, **kwargs):
+    flags = _libvirt_flags(_LIBVIRT_XML_FLAGS, kwargs)
+    xml = _libvirt_call(self._host,
+                        lambda conn: _libvirt_domain(conn, domain).XMLDesc(flags))
+    return from_xml(etree.fromstring(xml), ['disk', 'interface'])['domain']
+
+def __libvirt_domain_blkstat(self, domain, device='', **kwargs):
+    stats = _libvirt_call(self._host,
+                          lambda conn: _libvirt_domain(conn, domain)
+                                       .blockStatsFlags(device))
+    return {_LIBVIRT_BLKSTAT_KEYS.get(key, key): str(value)
+            for key, value in stats.items()}
+
+def __libvirt_domain_ifstat(self, domain, interface, **kwargs):
+    stats = _libvirt_call(self._host,
+                          lambda conn: _libvirt_domain(conn, domain)
+                                       .interfaceStats(interface))
+    return dict(zip(_LIBVIRT_IFSTAT_KEYS, (str(value) for value in stats)))
+
+def __libvirt_domain_memstat(self, domain, **kwargs):
+    stats = _libvirt_call(self._host,
+                          lambda conn: _libvirt_domain(conn, domain).memoryStats())
+    return {key: str(value) for key, value in stats.items()}
+
+
 class _Image(object):
     def __init__(self, host):
         self._host = host
 
+    def _execute(self, command, *args, **kwargs):
+        return _hooked(self._host, command, args, kwargs,
+                       lambda: self._host.execute(command, *args, **kwargs))
+
     def check(self, path, **kwargs):
-        return self._host.execute('qemu-img check', path, **kwargs)
+        return self._execute('qemu-img check', path, **kwargs)
 
     def create(self, path, size, **kwargs):
-        return self._host.execute('qemu-img create', path, size, **kwargs)
+        return self._execute('qemu-img create', path, size, **kwargs)
 
     def commit(self, path, **kwargs):
-        return self._host.execute('qemu-img commit', path, **kwargs)
+        return self._execute('qemu-img commit', path, **kwargs)
 
     def compare(self, *paths, **kwargs):
-        return self._host.execute('qemu-img compare', *paths, **kwargs)
+        return self._execute('qemu-img compare', *paths, **kwargs)
 
     def convert(self, src_path, dst_path, **kwargs):
         with self._host.set_controls(options_place='after'):
-            return self._host.execute('qemu-img convert', src_path, dst_path, **kwargs)
+            return self._execute('qemu-img convert', src_path, dst_path, **kwargs)
 
     def info(self, path, **kwargs):
-        status, stdout, stderr = self._host.execute('qemu-img info', path, **kwargs)
+        """Return informations on the image **path**. With the *output*
+        option set to ``json``, the JSON output of ``qemu-img`` is returned
+        with sizes as integers (in bytes), snapshots and format specific
+        informations, keys having ``_`` instead of ``-``. With the
+        *backing_chain* option, a list with the informations of each image of
+        the backing chain is then returned."""
+        status, stdout, stderr = self._execute('qemu-img info', path, **kwargs)
         if not status:
             raise OSError(stderr)
+        if kwargs.get('output') == 'json':
+            import json
+            return _json_keys(json.loads(stdout))
         return _dict(stdout.splitlines())
 
     def map(self, path, **kwargs):
-        return self._host.execute('qemu-img map', path, **kwargs)
+        """Map of the image **path**. With the *output* option set to
+        ``json``, an ``ExtentMap`` is returned."""
+        result = self._execute('qemu-img map', path, **kwargs)
+        if kwargs.get('output') != 'json':
+            return result
+        status, stdout, stderr = result
+        if not status:
+            raise OSError(stderr)
+        import json
+        return ExtentMap.from_json(json.loads(stdout))
+
+    def sparse_copy(self, src_path, dst_path, merge_gap=1048576, chunk_size=500):
+        """Copy the raw image **src_path** to **dst_path** reading and writing
+        only its data extents, so the copy of a thin provisioned image costs
+        the size of its data. Extents separated by less than **merge_gap**
+        bytes are copied together and at most **chunk_size** extents are
+        copied by command. Return the status, stdout and stderr of the
+        copy."""
+        try:
+            from shlex import quote
+        except ImportError:
+            from pipes import quote
+        info = self.info(src_path, output='json')
+        if info['format'] != 'raw':
+            raise OSError("sparse copy needs a raw image, not '%s'" % info['format'])
+        extents = list(self.map(src_path, output='json').data_extents(merge_gap))
+
+        src, dst = quote(src_path), quote(dst_path)
+        commands = ['truncate -s 0 %s' % dst,
+                    'truncate -s %d %s' % (info['virtual_size'], dst)]
+        commands.extend('dd if=%s of=%s bs=4M iflag=skip_bytes,count_bytes '
+                        'oflag=seek_bytes conv=notrunc status=none '
+                        'skip=%d seek=%d count=%d'
+                        % (src, dst, start, start, length)
+                        for start, length in extents)
+        host = self._host
+        for index in range(0, len(commands), chunk_size):
+            command = 'sh -c %s' % quote(' && '.join(commands[index:index + chunk_size]))
+            result = _hooked(host, 'dd', (src_path, dst_path), {},
+                             lambda: host.execute(command))
+            if not result[0]:
+                return result
+        return result
 
     def snapshot(self, path, **kwargs):
-        return self._host.execute('qemu-img snapshot', path, **kwargs)
+        return self._execute('qemu-img snapshot', path, **kwargs)
 
     def rebase(self, path, **kwargs):
-        return self._host.execute('qemu-img rebase', path, **kwargs)
+        return self._execute('qemu-img rebase', path, **kwargs)
 
     def resize(self, path, size):
-        return self._host.execute('qemu-img resize', path, size)
+        return self._execute('qemu-img resize', path, size)
 
     def amend(self, path, **kwargs):
-        return self._host.execute('qemu-img amend', path, **kwargs)
+        return self._execute('qemu-img amend', path, **kwargs)
 
     def load(self, path, device='nbd0', **kwargs):
         kwargs['c'] = '/dev/%s' % device
         kwargs['d'] = False
-        return self._host.execute('qemu-nbd', path, **kwargs)
+        return self._execute('qemu-nbd', path, **kwargs)
 
     def unload(self, device='nbd0', **kwargs):
         kwargs['c'] = False
         kwargs['d'] = '/dev/%s' % device
-        return self._host.execute('qemu-nbd', **kwargs)
+        return self._execute('qemu-nbd', **kwargs)
+
+    def pipeline(self, max_parallel=4, max_per_disk=1, progress=None):
+        """Return a pipeline of conversions (see ``_ConvertPipeline``)."""
+        return _ConvertPipeline(self, max_parallel, max_per_disk, progress)
+
+# Flags of extents of an 'ExtentMap'.
+EXTENT_DATA = 1
+EXTENT_ZERO = 2
+EXTENT_PRESENT = 4
+
+# Type of arrays of offsets and lengths (unsigned long long).
+_OFFSET_TYPE = 'Q' if sys.version_info >= (3, 3) else 'L'
+
+class ExtentMap(object):
+    """Extents of an image, as given by ``qemu-img map --output=json``. For
+    keeping maps of big images small, the start, length, depth (0 for the
+    image itself, 1 for its backing file, ...) and flags (``EXTENT_DATA``,
+    ``EXTENT_ZERO`` and ``EXTENT_PRESENT``) of extents are stored in arrays.
+    Iterating on a map yields tuples with these values."""
+    def __init__(self):
+        from array import array
+        self.starts = array(_OFFSET_TYPE)
+        self.lengths = array(_OFFSET_TYPE)
+        self.depths = array('B')
+        self.flags = array('B')
+
+    @classmethod
+    def from_json(cls, extents):
+        """Return the map of **extents** (a list of dictionnaries)."""
+        extent_map = cls()
+        for extent in extents:
+            extent_map.starts.append(extent['start'])
+            extent_map.lengths.append(extent['length'])
+            extent_map.depths.append(extent.get('depth', 0))
+            extent_map.flags.append(
+                (EXTENT_DATA if extent.get('data') else 0)
+                | (EXTENT_ZERO if extent.get('zero') else 0)
+                | (EXTENT_PRESENT if extent.get('present', True) else 0))
+        return extent_map
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.lengths, self.depths, self.flags)
+
+    @property
+    def size(self):
+        """Virtual size covered by the map."""
+        return self.starts[-1] + self.lengths[-1] if self.starts else 0
+
+    def find(self, offset):
+        """Return the index of the extent containing **offset** (or -1)."""
+        import bisect
+        index = bisect.bisect_right(self.starts, offset) - 1
+        if index >= 0 and offset < self.starts[index] + self.lengths[index]:
+            return index
+        return -1
+
+    def allocated(self, depth=None):
+        """Return the number of bytes of data (of the layer **depth** only if
+        set)."""
+        return sum(length
+                   for length, extent_depth, flags
+                   in zip(self.lengths, self.depths, self.flags)
+                   if flags & EXTENT_DATA
+                   and (depth is None or extent_depth == depth))
+
+    def data_extents(self, merge_gap=0):
+        """Yield tuples with the start and length of the ranges containing
+        data. Ranges separated by at most **merge_gap** bytes are merged."""
+        current = None
+        for start, length, _, flags in self:
+            if not flags & EXTENT_DATA:
+                continue
+            if current is not None and start - sum(current) <= merge_gap:
+                current = (current[0], start + length - current[0])
+                continue
+            if current is not None:
+                yield current
+            current = (start, length)
+        if current is not None:
+            yield current
+
+    def divergence(self):
+        """Return the number of bytes written in the image itself (*overlay*),
+        only read from its backing chain (*backing*) or not allocated at all
+        (*unallocated*), with the *size* of the image and the *ratio* of the
+        size written in the image."""
+        overlay = backing = 0
+        for _, length, depth, flags in self:
+            if flags & EXTENT_PRESENT and depth == 0:
+                overlay += length
+            elif flags & EXTENT_PRESENT:
+                backing += length
+        size = self.size
+        return {'size': size,
+                'overlay': overlay,
+                'backing': backing,
+                'unallocated': size - overlay - backing,
+                'ratio': float(overlay) / size if size else 0.0}
+
+def _json_keys(value):
+    """Replace ``-`` by ``_`` in keys of dictionnaries of **value** (a JSON
+    output of ``qemu-img``)."""
+    if isinstance(value, dict):
+        return {key.replace('-', '_'): _json_keys(val)
+                for key, val in value.items()}
+    elif isinstance(value, list):
+        return [_json_keys(val) for val in value]
+    return value
+
+# Options of 'qemu-img convert' by name.
+_CONVERT_OPTIONS = {'src_format': 'f', 'output_format': 'O', 'options': 'o',
+                    'coroutines': 'm', 'out_of_order': 'W', 'cache': 't',
+                    'src_cache': 'T', 'compress': 'c', 'sparse_size': 'S',
+                    'no_create': 'n'}
+
+# Regular expression for matching progress printed by 'qemu-img convert -p'.
+_PROGRESS_RE = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+
+# Regular expression for matching the virtual size printed by 'qemu-img info'.
+_VIRTUAL_SIZE_RE = re.compile(r'\((\d+) bytes\)')
+
+class _ConvertPipeline(object):
+    """Conversions of images (with ``qemu-img convert``) executed in parallel.
+    At most **max_parallel** conversions are executed at the same time and at
+    most **max_per_disk** conversions write on the same disk (by default, the
+    disk of a conversion is the directory of its destination). **progress**
+    is a function called with the report of a conversion each time its
+    progress (in percent) changes.
+
+    Conversions are added with ``add`` and executed with ``run``, which
+    returns their reports. Throughputs are computed from the virtual sizes of
+    source images.
+    """
+    def __init__(self, image, max_parallel=4, max_per_disk=1, progress=None):
+        self._image = image
+        self.max_parallel = max_parallel
+        self.max_per_disk = max_per_disk
+        self.progress = progress
+        self.conversions = []
+        self.stats = {}
+
+    def __len__(self):
+        return len(self.conversions)
+
+    def add(self, src_path, dst_path, disk=None, **kwargs):
+        """Add the conversion of **src_path** to **dst_path** writing on
+        **disk**. **kwargs** are options of ``qemu-img convert``, which can be
+        given by name: *src_format* (``-f``), *output_format* (``-O``),
+        *options* (``-o``), *coroutines* (``-m``), *out_of_order* (``-W``),
+        *cache* (``-t``), *src_cache* (``-T``), *compress* (``-c``),
+        *sparse_size* (``-S``) and *no_create* (``-n``). Return the report of
+        the conversion, updated during its execution."""
+        options = {_CONVERT_OPTIONS.get(option, option): value
+                   for option, value in kwargs.items()}
+        options['p'] = True
+        conversion = {'src_path': src_path,
+                      'dst_path': dst_path,
+                      'disk': disk or os.path.dirname(dst_path.rstrip('/')),
+                      'options': options,
+                      'status': None,
+                      'error': None,
+                      'progress': 0.0,
+                      'size': None,
+                      'duration': None,
+                      'throughput': None}
+        self.conversions.append(conversion)
+        return conversion
+
+    def _convert(self, conversion):
+        import time
+        start = time.time()
+        host = self._image._host
+        src_path, dst_path = conversion['src_path'], conversion['dst_path']
+        status, stdout, _ = self._image._execute('qemu-img info', src_path)
+        match = _VIRTUAL_SIZE_RE.search(stdout) if status else None
+        conversion['size'] = int(match.group(1)) if match else None
+
+        hooks, call = _pre_hooks(host, 'qemu-img convert', (src_path, dst_path),
+                                 conversion['options'])
+        with host.set_controls(options_place='after'):
+            proc = _spawn(host, 'qemu-img convert', src_path, dst_path,
+                          **conversion['options'])
+        status, stderr, buf = False, '', ''
+        try:
+            for data in iter(proc.read, ''):
+                # Progress is rewritten on the same line with '\r'.
+                buf = buf[-64:] + data
+                values = _PROGRESS_RE.findall(buf)
+                if values and float(values[-1]) != conversion['progress']:
+                    conversion['progress'] = float(values[-1])
+                    if self.progress is not None:
+                        self.progress(conversion)
+            status = proc.wait() == 0
+            stderr = proc.read_stderr().rstrip('\n')
+        finally:
+            proc.close()
+            if hooks:
+                _post_hooks(hooks, call, status, 0, len(stderr))
+
+        duration = time.time() - start
+        conversion.update(status=status,
+                          error=stderr or None,
+                          duration=duration)
+        if status:
+            conversion['progress'] = 100.0
+            if conversion['size'] is not None and duration > 0:
+                conversion['throughput'] = conversion['size'] / duration
+
+    def run(self):
+        """Execute the conversions added since the last run and return their
+        reports (in the order they were added). Aggregated statistics (number
+        of conversions and errors, size, duration and throughput) are put in
+        the ``stats`` attribute."""
+        import time
+        conversions, self.conversions = self.conversions, []
+        pending = list(conversions)
+        running = {}
+        cond = threading.Condition()
+        start = time.time()
+
+        def convert(conversion):
+            try:
+                self._convert(conversion)
+            except Exception as err:
+                conversion.update(status=False, error=str(err))
+            finally:
+                with cond:
+                    running[conversion['disk']] -= 1
+                    cond.notify()
+
+        with cond:
+            while pending or any(running.values()):
+                for conversion in list(pending):
+                    disk = conversion['disk']
+                    if (sum(running.values()) < self.max_parallel
+                      and running.get(disk, 0) < self.max_per_disk):
+                        pending.remove(conversion)
+                        running[disk] = running.get(disk, 0) + 1
+                        thread = threading.Thread(target=convert,
+                                                  args=(conversion,))
+                        thread.daemon = True
+                        thread.start()
+                cond.wait()
+
+        duration = time.time() - start
+        size = sum(conversion['size'] or 0 for conversion in conversions
+                   if conversion['status'])
+        self.stats = {'conversions': len(conversions),
+                      'errors': sum(1 for conversion in conversions
+                                    if not conversion['status']),
+                      'size': size,
+                      'duration': duration,
+                      'throughput': size / duration if duration > 0 else None}
+        return conversions
+
+
+class ImageIndex(object):
+    """Index of the informations of images (see ``_Image.info`` with the JSON
+    output) of **hypervisor**, indexed by path. The size and modification
+    time of files are kept with their informations so scanning a directory
+    again only runs ``qemu-img`` on added and modified files (``qemu-img`` is
+    run on **chunk_size** files per command). Informations of an image are
+    got with ``index[path]`` and its backing chain with ``chain``. The index
+    can be saved with ``dump`` and loaded with ``load``.
+    """
+    def __init__(self, hypervisor, entries=None, chunk_size=100):
+        self.hypervisor = hypervisor
+        self.chunk_size = chunk_size
+        # Size, modification time and informations of images by path.
+        self.entries = entries or {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __getitem__(self, path):
+        return self.entries[path]['info']
+
+    def _files(self, directory, pattern):
+        """Return the size and modification time of files matching
+        **pattern** in **directory** (and its subdirectories)."""
+        try:
+            from shlex import quote
+        except ImportError:
+            from pipes import quote
+        status, stdout, stderr = self.hypervisor.execute(
+            "find %s -type f -name %s -printf '%%s %%T@ %%p\\n'"
+            % (quote(directory), quote(pattern)))
+        if not status:
+            raise OSError(stderr)
+        files = {}
+        for line in stdout.splitlines():
+            size, mtime, path = line.split(' ', 2)
+            files[path] = (int(size), float(mtime))
+        return files
+
+    def _infos(self, paths):
+        """Return informations of images **paths** (or the error for images
+        that could not be read) in a single command."""
+        import json
+        try:
+            from shlex import quote
+        except ImportError:
+            from pipes import quote
+        marker = '__kvm_image_%s__' % ''.join(random.choice(_CHOICES)
+                                              for _ in range(0, 8))
+        command = 'sh -c %s' % quote(
+            'for path in %s; do echo %s; '
+            'qemu-img info --output=json -U "$path" 2>&1; done'
+            % (' '.join(quote(path) for path in paths), marker))
+        host = self.hypervisor
+        status, stdout, stderr = _hooked(
+            host, 'qemu-img info', tuple(paths), {'output': 'json'},
+            lambda: host.execute(command))
+        outputs = stdout.split('%s\n' % marker)[1:]
+        infos = {}
+        for path, output in zip(paths, outputs):
+            try:
+                infos[path] = _json_keys(json.loads(output))
+            except ValueError:
+                infos[path] = OSError(output.strip())
+        for path in paths[len(outputs):]:
+            infos[path] = OSError(stderr or 'image not read')
+        return infos
+
+    def scan(self, directory, pattern='*'):
+        """Update the index with the images matching **pattern** in
+        **directory**. Return a dictionnary with the lists of *added*,
+        *changed* and *removed* paths and the images in *errors* (with their
+        error) which are not indexed."""
+        files = self._files(directory, pattern)
+        prefix = directory.rstrip('/') + '/'
+        removed = [path for path in self.entries
+                   if path.startswith(prefix) and path not in files]
+        for path in removed:
+            del self.entries[path]
+
+        outdated = [path for path, (size, mtime) in sorted(files.items())
+                    if path not in self.entries
+                    or (self.entries[path]['size'], self.entries[path]['mtime'])
+                       != (size, mtime)]
+        added, changed, errors = [], [], {}
+        for index in range(0, len(outdated), self.chunk_size):
+            chunk = outdated[index:index + self.chunk_size]
+            for path, info in self._infos(chunk).items():
+                if isinstance(info, Exception):
+                    errors[path] = str(info)
+                    self.entries.pop(path, None)
+                    continue
+                (changed if path in self.entries else added).append(path)
+                size, mtime = files[path]
+                self.entries[path] = {'size': size, 'mtime': mtime, 'info': info}
+        return {'added': added, 'changed': changed, 'removed': removed,
+                'errors': errors}
+
+    def scan_pool(self, pool, pattern='*'):
+        """Update the index with the images of the directory of **pool**."""
+        target = self.hypervisor.pool.conf(pool)['target']['path']
+        return self.scan(target, pattern)
+
+    def chain(self, path):
+        """Return the list of informations of the images of the backing chain
+        of **path** (starting with **path**). Images not in the index are
+        read with ``qemu-img``."""
+        chain, seen = [], set()
+        while path and path not in seen:
+            seen.add(path)
+            if path in self.entries:
+                info = self.entries[path]['info']
+            else:
+                info = self.hypervisor.image.info(path, output='json', U=True)
+            chain.append(info)
+            path = info.get('full_backing_filename', info.get('backing_filename'))
+        return chain
+
+    def dump(self, fhandler):
+        """Save the index (in JSON) in the file object **fhandler**."""
+        import json
+        json.dump(self.entries, fhandler)
+
+    @classmethod
+    def load(cls, hypervisor, fhandler, chunk_size=100):
+        """Return an index of **hypervisor** loaded from **fhandler**."""
+        import json
+        return cls(hypervisor, json.load(fhandler), chunk_size)
+
+#
+# Fleet of hypervisors.
+#
+def _hostname(host):
+    if unix.ishost(host, 'Remote'):
+        return host.fqdn or host.ipv4 or host.ipv6
+    return 'localhost'
+
+class Fleet(object):
+    """Group of hypervisors on which functions are executed in parallel.
+    **hypervisors** is a dictionnary of ``Hypervisor`` objects indexed by name
+    or a list of ``Hypervisor`` objects (indexed then by their hostname). At
+    most **max_workers** hypervisors are processed at the same time and the
+    execution of a function on a hypervisor fails when it takes more than
+    **timeout** seconds (there is no timeout by default).
+    """
+    def __init__(self, hypervisors, max_workers=16, timeout=None):
+        if not isinstance(hypervisors, dict):
+            hypervisors = OrderedDict((_hostname(hypervisor), hypervisor)
+                                      for hypervisor in hypervisors)
+        self.hypervisors = hypervisors
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def __len__(self):
+        return len(self.hypervisors)
+
+    def __iter__(self):
+        return iter(self.hypervisors.items())
+
+    def imap(self, func, timeout=None):
+        """Execute **func** with each hypervisor as argument and yield, as
+        soon as they are available, tuples containing the name of the
+        hypervisor, the result of the function (``None`` on error) and the
+        exception raised (``None`` on success). An execution exceeding
+        **timeout** (default to the timeout of the fleet) is reported with a
+        **TimeoutException** exception but the thread executing it can not be
+        interrupted."""
+        import time
+        from concurrent import futures
+
+        timeout = timeout if timeout is not None else self.timeout
+        starts = {}
+        lock = threading.Lock()
+
+        def run(name, hypervisor):
+            with lock:
+                starts[name] = time.time()
+            return func(hypervisor)
+
+        executor = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            pending = {executor.submit(run, name, hypervisor): name
+                       for name, hypervisor in self.hypervisors.items()}
+            while pending:
+                wait_time = None
+                if timeout is not None:
+                    now = time.time()
+                    with lock:
+                        deadlines = [starts[name] + timeout
+                                     for name in pending.values()
+                                     if name in starts]
+                    # Queued executions have no deadline yet, so wake up
+                    # regularly for computing their deadline once started.
+                    wait_time = max(0, min(deadlines or [now + timeout]) - now)
+                    wait_time = min(wait_time, timeout)
+                done = futures.wait(pending, wait_time,
+                                    return_when=futures.FIRST_COMPLETED)[0]
+                for future in done:
+                    name = pending.pop(future)
+                    error = future.exception()
+                    yield (name,
+                           future.result() if error is None else None,
+                           error)
+
+                if timeout is not None:
+                    now = time.time()
+                    for future, name in list(pending.items()):
+                        with lock:
+                            start = starts.get(name)
+                        if start is not None and now - start >= timeout:
+                            del pending[future]
+                            future.cancel()
+                            yield (name, None, TimeoutException(
+                                'execution on %s exceeded %ss' % (name, timeout)))
+        finally:
+            executor.shutdown(wait=False)
+
+    def map(self, func, timeout=None):
+        """Execute **func** with each hypervisor as argument. Return a tuple
+        with a dictionnary of the results and a dictionnary of the exceptions
+        raised, both indexed by the name of the hypervisors."""
+        results, errors = {}, {}
+        for name, result, error in self.imap(func, timeout):
+            if error is None:
+                results[name] = result
+            else:
+                errors[name] = error
+        return results, errors
+
+
+#
+# Identifiers.
+#
+def _identifiers(hypervisor):
+    """Return the sets of uuids and mac addresses of the domains of
+    **hypervisor**."""
+    domains = hypervisor.list_domains(all=True)
+    with hypervisor.batch() as batch:
+        confs = [batch.domain.conf(domain) for domain in domains]
+
+    uuids, macs = set(), set()
+    for call in confs:
+        if call.exception() is not None:
+            # Domain undefined since listed.
+            continue
+        conf = call.result()
+        uuids.add(conf['uuid'].lower())
+        macs.update(interface['mac']['@address'].lower()
+                    for interface in conf.get('devices', {}).get('interface', [])
+                    if isinstance(interface.get('mac'), dict))
+    return uuids, macs
+
+class IdAllocator(object):
+    """Allocator of uuids and mac addresses not used by domains. Identifiers
+    in use are indexed in sets (by ``scan`` for the domains of hypervisors or
+    by ``add``) and random identifiers are drawn until one is not in the
+    index, so an allocation costs one draw while the index is far from full.
+    Allocated identifiers are added to the index. **rng** is the
+    ``random.Random`` object drawing identifiers (seeded from the system by
+    default). MAC addresses start with the 3 octets of **mac_prefix**
+    (``52:54:00``, the prefix of QEMU, by default). This object can be used
+    from several threads.
+    """
+    def __init__(self, mac_prefix='52:54:00', rng=None):
+        self.uuids = set()
+        self.macs = set()
+        self.mac_prefix = mac_prefix.lower()
+        self._prefix = tuple(int(octet, 16) for octet in mac_prefix.split(':'))
+        if len(self._prefix) != 3:
+            raise KvmError("invalid mac prefix '%s'" % mac_prefix)
+        self._nb_prefixed = 0
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.uuids) + len(self.macs)
+
+    def add(self, uuids=(), macs=()):
+        """Add **uuids** and **macs** to the identifiers in use."""
+        with self._lock:
+            self.uuids.update(uuid.lower() for uuid in uuids)
+            for mac in macs:
+                mac = mac.lower()
+                if mac not in self.macs:
+                    self.macs.add(mac)
+                    if mac.startswith(self.mac_prefix):
+                        self._nb_prefixed += 1
+
+    def release(self, uuids=(), macs=()):
+        """Remove **uuids** and **macs** (of removed domains) from the
+        identifiers in use."""
+        with self._lock:
+            self.uuids.difference_update(uuid.lower() for uuid in uuids)
+            for mac in macs:
+                mac = mac.lower()
+                if mac in self.macs:
+                    self.macs.remove(mac)
+                    if mac.startswith(self.mac_prefix):
+                        self._nb_prefixed -= 1
+
+    def scan(self, hypervisors):
+        """Add identifiers of the domains of **hypervisors** (a
+        ``Hypervisor`` or a ``Fleet`` scanned in parallel). Return a
+        dictionnary with the exceptions raised by hypervisors indexed by
+        their name."""
+        if not isinstance(hypervisors, Fleet):
+            hypervisors = Fleet([hypervisors])
+        results, errors = hypervisors.map(_identifiers)
+        for uuids, macs in results.values():
+            self.add(uuids, macs)
+        return errors
+
+    def _uuid(self):
+        import uuid
+        while True:
+            value = str(uuid.UUID(int=self._random.getrandbits(128), version=4))
+            if value not in self.uuids:
+                self.uuids.add(value)
+                return value
+
+    def _mac(self):
+        if self._nb_prefixed >= 1 << 24:
+            raise KvmError("no more mac address with prefix '%s'"
+                           % self.mac_prefix)
+        while True:
+            value = _format_mac(self._prefix, self._random.getrandbits(24))
+            if value not in self.macs:
+                self.macs.add(value)
+                self._nb_prefixed += 1
+                return value
+
+    def uuid(self):
+        """Return a (version 4) uuid not in use."""
+        with self._lock:
+            return self._uuid()
+
+    def mac(self):
+        """Return a mac address not in use."""
+        with self._lock:
+            return self._mac()
+
+    def reserve(self, nb_uuids=0, nb_macs=0):
+        """Return a dictionnary with lists of **nb_uuids** uuids and
+        **nb_macs** mac addresses not in use."""
+        with self._lock:
+            if self._nb_prefixed + nb_macs > 1 << 24:
+                raise KvmError("not enough mac addresses with prefix '%s'"
+                               % self.mac_prefix)
+            return {'uuids': [self._uuid() for _ in range(nb_uuids)],
+                    'macs': [self._mac() for _ in range(nb_macs)]}
+
+
+#
+# Inventory.
+#
+# Sections of an inventory.
+_INVENTORY_SECTIONS = ('domains', 'confs', 'snapshots', 'networks', 'pools',
+                       'volumes', 'secrets')
+
+def _diff(old, new):
+    """Return a dictionnary with the keys added to, removed from and changed
+    between the dictionnaries **old** and **new** (only non empty entries are
+    set). Changed keys are associated to a tuple with the old and new value."""
+    diff = {}
+    added = {key: value for key, value in new.items() if key not in old}
+    removed = {key: value for key, value in old.items() if key not in new}
+    changed = {key: (old[key], value) for key, value in new.items()
+               if key in old and old[key] != value}
+    for name, values in (('added', added), ('removed', removed),
+                         ('changed', changed)):
+        if values:
+            diff[name] = values
+    return diff
+
+class Inventory(object):
+    """Inventory of the objects of **hypervisor**: domains with their XML
+    configurations and snapshots, networks, pools with their volumes and
+    secrets. The inventory is kept in the ``data`` attribute, a dictionnary
+    indexed by section (``domains``, ``confs``, ``snapshots``, ``networks``,
+    ``pools``, ``volumes`` and ``secrets``).
+
+    ``update`` only lists domains, networks, pools and secrets (one command
+    each) and refetches the other objects when a cheap signal changes: the id
+    and state of a domain for its configuration and snapshots, the state and
+    usage of a pool for its volumes. The XML configurations are parsed only
+    when their digest changes. Objects not refetched since **max_age** seconds
+    are refetched anyway (``None`` for never). When **refresh_pools** is set,
+    active pools are refreshed before being listed so their usage reflects
+    changes made outside of libvirt.
+    """
+    def __init__(self, hypervisor, max_age=3600, refresh_pools=False):
+        self.hypervisor = hypervisor
+        self.max_age = max_age
+        self.refresh_pools = refresh_pools
+        self.data = {section: {} for section in _INVENTORY_SECTIONS}
+        self.updated = None
+        # Signal, time of fetch and digest of objects by (section, name).
+        self._signals = {}
+        self._fetched = {}
+        self._digests = {}
+
+    def _outdated(self, section, name, signal, now):
+        key = (section, name)
+        return (self._signals.get(key, _MISSING) != signal
+                or (self.max_age is not None
+                    and now - self._fetched[key] >= self.max_age))
+
+    def _domain_conf(self, domain):
+        """Return the digest of the XML configuration of **domain** and its
+        parsed configuration (``None`` when the digest has not changed)."""
+        import hashlib
+        status, stdout, stderr = self.hypervisor.virsh('dumpxml', domain)
+        if not status:
+            raise KvmError(stderr)
+        digest = hashlib.sha1(stdout.encode('utf-8')).hexdigest()
+        if digest == self._digests.get(('confs', domain)):
+            return digest, None
+        return digest, _parse(_MAPPING['domain']['conf'], stdout.splitlines())
+
+    def update(self):
+        """Update the inventory and return its differences with the previous
+        one, as a dictionnary indexed by section. Each section contains the
+        ``added``, ``removed`` and ``changed`` objects (see ``_diff``); only
+        sections with differences are returned. The first update returns the
+        whole inventory as added objects."""
+        import time
+        now = time.time()
+        hypervisor, old = self.hypervisor, self.data
+        new = {section: {} for section in _INVENTORY_SECTIONS}
+        signals, fetched, digests = {}, {}, {}
+
+        def refetch(section, name, signal, func):
+            key = (section, name)
+            if not self._outdated(section, name, signal, now):
+                new[section][name] = old[section][name]
+                signals[key], fetched[key] = signal, self._fetched[key]
+                if key in self._digests:
+                    digests[key] = self._digests[key]
+                return
+            # Objects removed between the listing and the fetch are ignored
+            # and objects failing to be fetched are retried at next update.
+            try:
+                new[section][name] = func(name)
+            except KvmError:
+                if name in old[section]:
+                    new[section][name] = old[section][name]
+                return
+            signals[key], fetched[key] = signal, now
+
+        def conf(domain):
+            digest, value = self._domain_conf(domain)
+            digests[('confs', domain)] = digest
+            return old['confs'][domain] if value is None else value
+
+        new['domains'] = hypervisor.list_domains(all=True)
+        new['networks'] = hypervisor.list_networks(all=True)
+        new['secrets'] = hypervisor.list_secrets()
+        if self.refresh_pools:
+            for pool, infos in hypervisor.list_pools(all=True).items():
+                if infos['state'] == 'active':
+                    hypervisor.pool.refresh(pool)
+        new['pools'] = hypervisor.list_pools(all=True, details=True)
+
+        for domain, infos in new['domains'].items():
+            signal = (infos['id'], infos['state'])
+            refetch('confs', domain, signal, conf)
+            refetch('snapshots', domain, signal, hypervisor.list_snapshots)
+        for pool, infos in new['pools'].items():
+            if infos['state'] not in ('active', 'running'):
+                continue
+            signal = (infos['state'], infos.get('allocation'),
+                      infos.get('available'))
+            refetch('volumes', pool, signal,
+                    lambda pool: hypervisor.list_volumes(pool, details=True))
+
+        self._signals, self._fetched, self._digests = signals, fetched, digests
+        self.data, self.updated = new, now
+        diff = {}
+        for section in _INVENTORY_SECTIONS:
+            section_diff = _diff(old[section], new[section])
+            if section_diff:
+                diff[section] = section_diff
+        return diff
+
+
+#
+# Statistics sampler.
+#
+# Counters of 'domstats' groups for which samplers compute rates.
+_SAMPLER_COUNTERS = {
+    'cpu': ('time', 'user', 'system'),
+    'block': ('rd_reqs', 'rd_bytes', 'wr_reqs', 'wr_bytes', 'fl_reqs'),
+    'net': ('rx_bytes', 'rx_pkts', 'rx_errs', 'rx_drop',
+            'tx_bytes', 'tx_pkts', 'tx_errs', 'tx_drop'),
+}
+
+def _counters(stats):
+    """Return the counters of **stats** (a result of ``domain_stats``) as a
+    flat dictionnary indexed by tuples ``(domain, group, device, counter)``
+    (device is ``None`` for the *cpu* group)."""
+    counters = {}
+    for domain, groups in stats.items():
+        for key in _SAMPLER_COUNTERS['cpu']:
+            if key in groups.get('cpu', {}):
+                counters[domain, 'cpu', None, key] = groups['cpu'][key]
+        for group in ('block', 'net'):
+            for device, values in groups.get(group, {}).items():
+                for key in _SAMPLER_COUNTERS[group]:
+                    if key in values:
+                        counters[domain, group, device, key] = values[key]
+    return counters
+
+class Sampler(object):
+    """Sampler of the statistics of **domains** (all by default) of
+    **hypervisor**, polled every **interval** seconds with a single
+    ``domain_stats`` call. Each sample gives the rates of counters since the
+    previous sample, indexed by domain, group and device::
+
+        {'guest1': {'cpu': {'time': 112.5, 'user': 80.2, 'system': 20.1},
+                    'block': {'vda': {'rd_reqs': 120.0, 'rd_bytes': 491520.0,
+                                      ...}},
+                    'net': {'vnet0': {'rx_bytes': 1500.0, 'rx_pkts': 2.5,
+                                      ...}}}}
+
+    CPU rates are percents of a physical CPU (so up to 100 times the number
+    of vcpus), other rates are per second (IOPS, bytes/s, packets/s). When a
+    counter decreased (the domain has been restarted), its rate is computed
+    from zero. Only the counters of the previous sample are kept and the last
+    **size** samples are kept in ``history`` as tuples with their time.
+
+    Iterating on a sampler yields a sample every **interval** seconds.
+    """
+    def __init__(self, hypervisor, domains=None, interval=10, size=60):
+        import collections
+        self.hypervisor = hypervisor
+        self.domains = domains
+        self.interval = interval
+        self.history = collections.deque(maxlen=size)
+        self._previous = None
+
+    def _stats(self):
+        return self.hypervisor.domain_stats(
+            self.domains, groups=('state', 'cpu_total', 'interface', 'block'))
+
+    def add(self, stats, timestamp):
+        """Add the statistics **stats** (a result of ``domain_stats``) got at
+        **timestamp** and return the rates since the previous statistics
+        (``None`` for the first ones)."""
+        counters = _counters(stats)
+        previous, self._previous = self._previous, (timestamp, counters)
+        if previous is None or timestamp <= previous[0]:
+            return None
+
+        duration = timestamp - previous[0]
+        rates = {}
+        for key, value in counters.items():
+            last = previous[1].get(key)
+            if last is None:
+                continue
+            domain, group, device, counter = key
+            # Counters are reset when a domain is restarted.
+            delta = value - last if value >= last else value
+            if group == 'cpu':
+                rates.setdefault(domain, {}).setdefault('cpu', {})[counter] = (
+                    delta / 1e9 / duration * 100)
+            else:
+                (rates.setdefault(domain, {}).setdefault(group, {})
+                      .setdefault(device, {}))[counter] = float(delta) / duration
+        self.history.append((timestamp, rates))
+        return rates
+
+    def sample(self):
+        """Get the statistics of domains and return the rates since the
+        previous sample (``None`` for the first sample)."""
+        import time
+        return self.add(self._stats(), time.time())
+
+    def __iter__(self):
+        import time
+        self.sample()
+        next_time = time.time() + self.interval
+        while True:
+            time.sleep(max(0, next_time - time.time()))
+            next_time += self.interval
+            rates = self.sample()
+            if rates is not None:
+                yield rates
+
+
+# The asyncio interface is imported on first access as asyncio is long to load.
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in ('AsyncHypervisor', 'AsyncSampler'):
+            from kvm import _aio
+            return getattr(_aio, name)
+        raise AttributeError("module '%s' has no attribute '%s'"
+                             % (__name__, name))
+elif sys.version_info >= (3, 5):
+    from kvm import _aio
+    AsyncHypervisor, AsyncSampler = _aio.AsyncHypervisor, _aio.AsyncSampler
@@ -0,0 +1,228 @@
+"""asyncio interface for managing KVM hosts (python 3.5+)."""
+
+import time
+import asyncio
+import unix
+
+from kvm import (_MAPPING, _format_args, _parse, _domains_options, _domains,
+                 _networks, _interfaces, _pools, _volumes, _secrets,
+                 _snapshots, _domstats, _domstats_records, _DOMSTATS_GROUPS,
+                 KvmError, SHUTOFF, Sampler)
+
+
+async def _local_execute(command, decode):
+    proc = await asyncio.create_subprocess_shell(command,
+                                                 stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    return [proc.returncode == 0,
+            stdout.decode(decode) if decode else stdout,
+            stderr.decode(decode) if decode else stderr]
+
+async def _remote_execute(host, command, decode):
+    """Execute **command** in a new channel of the SSH connection of **host**.
+    Only the opening of the channel is done in a thread, outputs are read
+    when the channel is signaled as readable by the event loop."""
+    loop = asyncio.get_event_loop()
+
+    def open_channel():
+        host.is_connected()
+        chan = host._conn.get_transport().open_session()
+        chan.exec_command(command)
+        return chan
+    chan = await loop.run_in_executor(None, open_channel)
+
+    stdout, stderr = [], []
+    finished = loop.create_future()
+    def read():
+        # EOF is checked before draining buffers, so data received with it
+        # is read before finishing.
+        eof = chan.eof_received
+        while chan.recv_ready():
+            stdout.append(chan.recv(65536))
+        while chan.recv_stderr_ready():
+            stderr.append(chan.recv_stderr(65536))
+        if eof and not finished.done():
+            finished.set_result(None)
+
+    fileno = chan.fileno()
+    loop.add_reader(fileno, read)
+    try:
+        await finished
+    finally:
+        loop.remove_reader(fileno)
+
+    if chan.exit_status_ready():
+        return_code = chan.recv_exit_status()
+    else:
+        return_code = await loop.run_in_executor(None, chan.recv_exit_status)
+    chan.close()
+    stdout, stderr = b''.join(stdout), b''.join(stderr)
+    return [return_code == 0,
+            stdout.decode(decode) if decode else stdout,
+            stderr.decode(decode) if decode else stderr]
+
+
+def _add_method(obj, method, conf):
+    cmd = conf.get('cmd', method)
+    ignore_opts = conf.get('disable', [])
+
+    async def parsed_method(self, *args, **kwargs):
+        return _parse(conf, await self._hypervisor._virsh(cmd, args, kwargs,
+                                                          ignore_opts))
+
+    async def tune_method(self, *args, **kwargs):
+        tune_opts = ('config', 'live', 'current')
+        if (not kwargs
+          or (len(kwargs) == 1 and any(opt in kwargs for opt in tune_opts))):
+            return await parsed_method(self, *args, **kwargs)
+        return await none_method(self, *args, **kwargs)
+
+    async def none_method(self, *args, **kwargs):
+        return await self._hypervisor.virsh(cmd, *args, **kwargs)
+
+    func = {'none': none_method, 'tune': tune_method}.get(conf['type'],
+                                                        parsed_method)
+    setattr(obj, method.replace('-', '_'), func)
+
+
+class _Property(object):
+    def __init__(self, hypervisor):
+        self._hypervisor = hypervisor
+
+async def _domain_stop(self, domain, timeout=30, force=False):
+    """Shutdown **domain** and wait (without blocking the event loop) for it
+    to be stopped. If it is still running after **timeout** seconds, it is
+    destroyed when **force** is set."""
+    if domain not in await self._hypervisor.list_domains(all=True):
+        return [False, '', 'Domain not found']
+
+    await self.shutdown(domain)
+    try:
+        await asyncio.wait_for(self._wait_shutoff(domain), timeout)
+    except asyncio.TimeoutError:
+        if force:
+            status, stdout, stderr = await self.destroy(domain)
+            if status:
+                stderr = 'VM has been destroyed after %ss' % timeout
+            return (status, stdout, stderr)
+        return (False, '', 'VM not stopped after %ss' % timeout)
+    return [True, '', '']
+
+async def _domain_wait_shutoff(self, domain):
+    while await self.state(domain) != SHUTOFF:
+        await asyncio.sleep(1)
+
+_PROPERTIES = {}
+for _property_name, _property_methods in _MAPPING.items():
+    _PROPERTIES[_property_name] = type('_Async%s' % _property_name.capitalize(),
+                                       (_Property,), {})
+    for _method_name, _method_conf in _property_methods.items():
+        _add_method(_PROPERTIES[_property_name], _method_name, _method_conf)
+_PROPERTIES['domain'].stop = _domain_stop
+_PROPERTIES['domain']._wait_shutoff = _domain_wait_shutoff
+
+
+class AsyncHypervisor(object):
+    """asyncio version of ``Hypervisor``. **host** must be an object of type
+    ``unix.Local`` or ``unix.Remote``. Commands are executed in asyncio
+    subprocesses for a local host and in SSH channels read by the event loop
+    for a remote host, so many commands can run concurrently without a
+    thread per command. ``virsh``, ``list_*`` and the methods of the
+    properties (``await hypervisor.domain.state('guest1')``) are coroutines
+    returning the same results than ``Hypervisor``.
+    """
+    def __init__(self, host, uri=None):
+        unix.isvalid(host)
+        self._host = host
+        self._uri = uri or 'qemu:///session'
+        for property_name, property_obj in _PROPERTIES.items():
+            setattr(self, property_name, property_obj(self))
+
+    async def execute(self, command):
+        """Execute **command** (a string) on the host and return a list with
+        the status, stdout and stderr of the command."""
+        command = self._host._format_command(command, (), {})[0]
+        if unix.ishost(self._host, 'Remote'):
+            return await _remote_execute(self._host, command, 'utf-8')
+        return await _local_execute(command, 'utf-8')
+
+    async def virsh(self, command, *args, **kwargs):
+        """Execute the virsh **command** and return a tuple with the status,
+        stdout and stderr of the command."""
+        status, stdout, stderr = await self.execute(
+            'virsh --connect %s %s %s' % (self._uri, command,
+                                           _format_args(args, kwargs)))
+        return status, stdout.rstrip('\n'), stderr.rstrip('\n')
+
+    async def _virsh(self, command, args, kwargs, ignore_opts=()):
+        """Execute the virsh **command** and return the lines of stdout or
+        raise **KvmError** with stderr."""
+        for opt in ignore_opts:
+            kwargs[opt] = False
+        status, stdout, stderr = await self.virsh(command, *args, **kwargs)
+        if not status:
+            raise KvmError(stderr)
+        stdout = stdout.splitlines()
+        return stdout[:-1] if stdout and not stdout[-1] else stdout
+
+    async def list_domains(self, **kwargs):
+        virsh_opts = _domains_options(kwargs)
+        return _domains(await self._virsh('list', (), virsh_opts),
+                        'title' in kwargs)
+
+    async def list_networks(self, **kwargs):
+        return _networks(await self._virsh('net-list', (), kwargs))
+
+    async def list_interfaces(self, **kwargs):
+        return _interfaces(await self._virsh('iface-list', (), kwargs))
+
+    async def list_pools(self, **kwargs):
+        return _pools(await self._virsh('pool-list', (), kwargs))
+
+    async def list_volumes(self, pool, **kwargs):
+        return _volumes(await self._virsh('vol-list', (pool,), kwargs))
+
+    async def list_secrets(self, **kwargs):
+        return _secrets(await self._virsh('secret-list', (), kwargs))
+
+    async def list_snapshots(self, domain, **kwargs):
+        kwargs.pop('tree', None)
+        kwargs.pop('name', None)
+        return _snapshots(await self._virsh('snapshot-list', (domain,), kwargs),
+                          'parent' in kwargs)
+
+    async def domain_stats(self, domains=None, groups=_DOMSTATS_GROUPS, **kwargs):
+        for group in groups:
+            kwargs[group] = True
+        stdout = await self._virsh('domstats', tuple(domains or ()), kwargs)
+        return _domstats(_domstats_records(stdout))
+
+
+class AsyncSampler(Sampler):
+    """asyncio version of ``Sampler`` for an ``AsyncHypervisor``. ``sample``
+    is a coroutine and samples are got with ``async for``."""
+    def __init__(self, hypervisor, domains=None, interval=10, size=60):
+        Sampler.__init__(self, hypervisor, domains, interval, size)
+        self._next_time = None
+
+    async def _stats(self):
+        return await self.hypervisor.domain_stats(
+            self.domains, groups=('state', 'cpu_total', 'interface', 'block'))
+
+    async def sample(self):
+        return self.add(await self._stats(), time.time())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._next_time is None:
+            await self.sample()
+            self._next_time = time.time()
+        while True:
+            self._next_time += self.interval
+            await asyncio.sleep(max(0, self._next_time - time.time()))
+            rates = await self.sample()
+            if rates is not None:
+                return rates
@@ -13,7 +13,9 @@ setup (
     description='An API for managing KVM host.',
     long_description=open('README.rst').read(),
     keywords = ['python', 'kvm', 'unix', 'virsh'],
-    install_requires=['unix', 'lxml'],
+    install_requires=['unix', 'lxml', 'futures; python_version < "3"',
+                      'enum34; python_version < "3.4"'],
+    extras_require={'libvirt': ['libvirt-python']},
 #    entry_points={'unix': ['Hypervisor = kvm.__init__:Hypervisor']},
     classifiers=[
         'License :: OSI Approved :: MIT License',